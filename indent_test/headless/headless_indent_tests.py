@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Run the indentation tests for Sublime Text syntaxes without Sublime Text, by
+evaluating the indentation rules (increaseIndentPattern, decreaseIndentPattern,
+bracketIndentNextLinePattern and unIndentedLinePattern) from the tmPreferences
+files of the packages directly.
+
+This uses the same indentation_test* files with the same INDENT TEST header as
+the run_indent_tests build target in the folder above, and produces the same
+output, so it can be used where there is no Sublime to run the tests in, such
+as the CI of a syntax package. Test files are run in parallel in a pool of
+processes.
+
+This can't know everything that Sublime does; in particular rules are chosen
+based on the main scope of the syntax of a test file, so rules for languages
+embedded in other languages are not used. See the README for more details.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from difflib import ndiff
+import fnmatch
+import logging
+import os
+import plistlib
+import re
+import sys
+import zipfile
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+
+log = logging.getLogger("headless_indent_tests")
+
+
+# The indentation rule settings that are evaluated; any other settings in the
+# tmPreferences files are ignored.
+_rule_settings = ("increaseIndentPattern", "decreaseIndentPattern",
+                  "bracketIndentNextLinePattern", "unIndentedLinePattern")
+
+# The escapes that Oniguruma (which Sublime uses) supports but which Python
+# doesn't, and what to use in their place.
+_escapes = {
+    "\\h": "[0-9A-Fa-f]",
+    "\\H": "[^0-9A-Fa-f]",
+    "\\z": "\\Z"
+}
+
+# Patterns already compiled in this process, by pattern.
+_compiled = {}
+
+
+### ---------------------------------------------------------------------------
+
+
+class Resources():
+    """
+    Provide access to the resources of all of the packages in a list of
+    folders, each of which is laid out like the Packages folder; packages are
+    either folders or sublime-package files. As in Sublime, files in a package
+    folder override those in a sublime-package file of the same name, and
+    packages in later folders override those in earlier ones.
+
+    Resources are named as Sublime names them, such as
+    Packages/C++/C.sublime-syntax.
+    """
+    def __init__(self, package_dirs):
+        self.resources = {}
+        self.folders = []
+
+        for package_dir in package_dirs:
+            package_dir = os.path.abspath(package_dir)
+            entries = sorted(os.listdir(package_dir))
+            self.folders.append(package_dir)
+
+            for entry in entries:
+                path = os.path.join(package_dir, entry)
+                if entry.endswith(".sublime-package") and os.path.isfile(path):
+                    self.add_archive(path, entry[:-len(".sublime-package")])
+
+            for entry in entries:
+                path = os.path.join(package_dir, entry)
+                if os.path.isdir(path):
+                    self.add_folder(path, entry)
+
+    def add_archive(self, archive, package):
+        """
+        Add all of the resources in the given sublime-package file.
+        """
+        try:
+            with zipfile.ZipFile(archive) as zFile:
+                for name in zFile.namelist():
+                    if not name.endswith("/"):
+                        self.resources["Packages/%s/%s" % (package, name)] = (archive, name)
+
+        except (OSError, zipfile.BadZipFile) as err:
+            log.warning("Unable to read %s: %s", archive, err)
+
+    def add_folder(self, folder, package):
+        """
+        Add all of the resources in the given package folder.
+        """
+        for path, dirs, files in os.walk(folder):
+            dirs.sort()
+            for file in sorted(files):
+                real_file = os.path.join(path, file)
+                name = os.path.relpath(real_file, folder).replace(os.sep, "/")
+                self.resources["Packages/%s/%s" % (package, name)] = (real_file, None)
+
+    @staticmethod
+    def load_order(name):
+        """
+        Sort key that puts resources in the order that Sublime loads packages;
+        Default first, User last and everything else in between by name.
+        """
+        package = name.split("/")[1]
+        return (package == "User", package != "Default", package, name)
+
+    def find(self, pattern):
+        """
+        Return the names of all resources whose file name matches the given
+        wildcard pattern, in load order.
+        """
+        names = [name for name in self.resources
+                 if fnmatch.fnmatchcase(name.rsplit("/", 1)[-1], pattern)]
+        return sorted(names, key=self.load_order)
+
+    def load_binary(self, name):
+        """
+        Return the content of the given resource as bytes.
+        """
+        location, member = self.resources[name]
+        if member is None:
+            with open(location, "rb") as file:
+                return file.read()
+
+        with zipfile.ZipFile(location) as zFile:
+            return zFile.read(member)
+
+    def load(self, name):
+        """
+        Return the content of the given resource as text; as with Sublime, line
+        endings are normalized.
+        """
+        text = self.load_binary(name).decode("utf-8")
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    def name_for(self, file_name):
+        """
+        Return the resource name of the given file on disk (which must be in a
+        package folder in one of the folders of packages), or None if the file
+        is not a resource.
+        """
+        real_file = os.path.abspath(file_name)
+        for folder in reversed(self.folders):
+            rel_name = os.path.relpath(real_file, folder)
+            if not rel_name.startswith(os.pardir + os.sep) and os.sep in rel_name:
+                name = "Packages/" + rel_name.replace(os.sep, "/")
+                if name in self.resources:
+                    return name
+
+        return None
+
+
+### ---------------------------------------------------------------------------
+
+
+def syntax_for_file(content):
+    """
+    Get the syntax for an indentation test out of its header, given the content
+    of the test; None if there isn't a header.
+    """
+    lines = content.splitlines()
+    match = re.match('^.*INDENT TEST "(.*?)"', lines[0] if lines else "")
+    if not match:
+        return None
+
+    return match.group(1)
+
+
+def syntax_scope(resources, syntax):
+    """
+    Return the main scope of the given syntax, which is either a
+    sublime-syntax file or a tmLanguage file. Returns None if the syntax is
+    missing or its scope can't be found.
+    """
+    if syntax not in resources.resources:
+        return None
+
+    try:
+        if syntax.endswith(".sublime-syntax"):
+            match = re.search(r"^scope:\s*(\S+)", resources.load(syntax), re.MULTILINE)
+            return match.group(1) if match else None
+
+        return plistlib.loads(resources.load_binary(syntax)).get("scopeName")
+
+    except Exception as err:
+        log.warning("Unable to read the syntax %s: %s", syntax, err)
+        return None
+
+
+def selector_score(selector, scope):
+    """
+    Return the score of the given scope selector against the given scope, for
+    comparing which of several selectors matches the scope best; None if it
+    doesn't match at all. An empty selector matches everything, with the
+    lowest score.
+
+    Only the main scope of a syntax is ever checked, so this only supports
+    what selectors for a main scope need; alternatives separated with commas
+    and exclusions with a minus.
+    """
+    if not selector.strip():
+        return (0, 0)
+
+    def matches(part):
+        atoms = part.split()
+        if len(atoms) != 1:
+            return None
+
+        segments = atoms[0].split(".")
+        if scope.split(".")[:len(segments)] != segments:
+            return None
+
+        return (1, len(segments))
+
+    best = None
+    for alternative in selector.split(","):
+        parts = re.split(r"\s-\s*", alternative)
+        score = matches(parts[0])
+        if score is None or any(matches(part) for part in parts[1:]):
+            continue
+
+        best = score if best is None else max(best, score)
+
+    return best
+
+
+def indent_rules(resources, scope):
+    """
+    Return the indentation rules for the given scope, as a dictionary of the
+    pattern for each rule that applies.
+
+    Every tmPreferences file whose scope selector matches the scope is used.
+    Each rule is taken from the file whose selector matches best; when that's
+    a tie, the file that Sublime loads last wins.
+    """
+    matched = []
+    for order, name in enumerate(resources.find("*.tmPreferences")):
+        try:
+            prefs = plistlib.loads(resources.load_binary(name))
+        except Exception as err:
+            log.warning("Unable to read %s: %s", name, err)
+            continue
+
+        settings = prefs.get("settings", {})
+        if not isinstance(settings, dict) or not any(key in settings for key in _rule_settings):
+            continue
+
+        score = selector_score(prefs.get("scope", ""), scope)
+        if score is not None:
+            matched.append((score, order, settings))
+
+    rules = {}
+    for score, order, settings in sorted(matched, key=lambda match: match[:2]):
+        for key in _rule_settings:
+            if isinstance(settings.get(key), str):
+                rules[key] = settings[key]
+
+    return rules
+
+
+### ---------------------------------------------------------------------------
+
+
+def compile_pattern(pattern):
+    """
+    Compile a pattern from an indentation rule, returning None if it can't be
+    compiled. This uses the regex module (which is much closer to what Sublime
+    supports) when it's installed, and re otherwise.
+    """
+    if pattern not in _compiled:
+        translated = re.sub(r"\\.", lambda m: _escapes.get(m.group(0), m.group(0)), pattern)
+        try:
+            _compiled[pattern] = (regex or re).compile(translated)
+        except Exception as err:
+            log.warning("Unable to compile indentation pattern %r: %s", pattern, err)
+            _compiled[pattern] = None
+
+    return _compiled[pattern]
+
+
+def reindent(lines, rules, indent_unit):
+    """
+    Indent the given lines (which have no indentation of their own) using the
+    given indentation rules, returning the indented lines.
+
+    Each line is indented based on the lines before it; a line matching the
+    increase pattern indents all of the lines after it, one matching the
+    bracket pattern indents only the line after it, and one matching the
+    decrease pattern is itself unindented. Lines matching the unindented line
+    pattern are indented but don't affect the lines after them, and empty
+    lines are left empty.
+    """
+    def matcher(rule):
+        pattern = compile_pattern(rules[rule]) if rule in rules else None
+        return (lambda text: pattern.search(text) is not None) if pattern else (lambda text: False)
+
+    increase = matcher("increaseIndentPattern")
+    decrease = matcher("decreaseIndentPattern")
+    bracket = matcher("bracketIndentNextLinePattern")
+    unindented = matcher("unIndentedLinePattern")
+
+    # The level of the current block, and the number of extra levels that the
+    # next line gets from lines matching the bracket pattern.
+    block = 0
+    extra = 0
+
+    result = []
+    for text in lines:
+        if not text.strip():
+            result.append("")
+            continue
+
+        closes = decrease(text)
+        level = max(0, block + extra - (1 if closes else 0))
+        result.append(indent_unit * level + text)
+
+        if unindented(text):
+            continue
+
+        if increase(text):
+            block, extra = level + 1, 0
+        else:
+            block = max(0, block - (1 if closes else 0))
+            extra = extra + 1 if bracket(text) else 0
+
+    return result
+
+
+def run_indent_test(package_file, content, rules, indent_unit):
+    """
+    Run the indentation test in the given file with the given content using
+    the given rules, returning a tuple of the number of lines in the test and
+    a list of the failures, in the same format as the run_indent_tests command.
+    """
+    input_lines = content.splitlines()
+    output_lines = reindent([line.lstrip() for line in input_lines], rules, indent_unit)
+
+    if input_lines == output_lines:
+        return (len(input_lines), [])
+
+    diff = ndiff(input_lines, output_lines)
+
+    line_num = 0
+    errors = []
+    for line in diff:
+        prefix = line[:2]
+        line_num += 1 if prefix in ("  ", "+ ") else 0
+
+        if prefix == "+ ":
+            msg = "{}:{}:1: Indent Failure: {}".format(package_file, line_num, line[2:])
+            errors.append(msg)
+
+    return (len(input_lines), errors)
+
+
+def _run_test(test):
+    """
+    Run a test in a pool process; test is a tuple of the arguments to
+    run_indent_test().
+    """
+    return run_indent_test(*test)
+
+
+### ---------------------------------------------------------------------------
+
+
+def prepare_tests(resources, tests, indent_unit):
+    """
+    Load the given tests and the rules that apply to each of them, returning a
+    list of tuples of the arguments to run_indent_test(). Tests that don't have
+    a header are run without rules and have no lines, as in Sublime.
+    """
+    prepared = []
+    rules_for = {}
+
+    for package_file in tests:
+        content = resources.load(package_file)
+        syntax = syntax_for_file(content)
+        if syntax is None:
+            prepared.append((package_file, "", {}, indent_unit))
+            continue
+
+        if syntax not in rules_for:
+            scope = syntax_scope(resources, syntax)
+            if scope is None:
+                log.warning("Unable to find the scope of the syntax %s", syntax)
+            rules_for[syntax] = indent_rules(resources, scope) if scope else {}
+
+        prepared.append((package_file, content, rules_for[syntax], indent_unit))
+
+    return prepared
+
+
+def run_indent_tests(resources, tests, indent_unit="    ", processes=None):
+    """
+    Run the given indentation tests (by resource name), several at once in a
+    pool of processes, returning a list of the result of each test in the same
+    order as the tests.
+    """
+    prepared = prepare_tests(resources, tests, indent_unit)
+    processes = processes or min(len(prepared), os.cpu_count() or 1)
+
+    if processes <= 1 or len(prepared) <= 1:
+        return [_run_test(test) for test in prepared]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_run_test, prepared, chunksize=4))
+
+
+def report(tests, results, output=sys.stdout):
+    """
+    Write out the results of the given tests in the same way as the
+    run_indent_tests command, returning True if they all passed.
+    """
+    total_lines = 0
+    failed_lines = 0
+
+    for lines, failures in results:
+        total_lines += lines
+        if len(failures) > 0:
+            failed_lines += len(failures)
+            for line in failures:
+                output.write(line + '\n')
+
+    if failed_lines > 0:
+        message = 'FAILED: {} of {} lines in {} files failed\n'
+        params = (failed_lines, total_lines, len(tests))
+    else:
+        message = 'Success: {} lines in {} files passed\n'
+        params = (total_lines, len(tests))
+
+    output.write(message.format(*params))
+    return failed_lines == 0
+
+
+### ---------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+    parser = argparse.ArgumentParser(description="Run Sublime Text indentation tests without Sublime")
+    parser.add_argument("tests",
+                        help="Indentation test files to run, either as a resource name "
+                             "(Packages/...) or a file in one of the package folders "
+                             "[Default: all of them]",
+                        nargs="*")
+    parser.add_argument("--packages", "-p",
+                        help="A folder of packages laid out like the Packages folder; can "
+                             "be given more than once, with later folders overriding "
+                             "earlier ones [Default: the current folder]",
+                        action="append")
+    parser.add_argument("--tab-size", "-t",
+                        help="The number of spaces in each level of indentation [Default: 4]",
+                        type=int,
+                        default=4)
+    parser.add_argument("--use-tabs",
+                        help="Indent with tabs instead of spaces",
+                        action="store_true")
+    parser.add_argument("--processes", "-P",
+                        help="Number of test files to run at once [Default: one per CPU]",
+                        type=int)
+
+    args = parser.parse_args()
+
+    resources = Resources(args.packages or ["."])
+
+    tests = []
+    for test in args.tests:
+        name = test if test in resources.resources else resources.name_for(test)
+        if name is None:
+            parser.error("%s is not a resource in any of the package folders" % test)
+        tests.append(name)
+
+    tests = tests or resources.find("indentation_test*")
+    indent_unit = "\t" if args.use_tabs else " " * args.tab_size
+
+    results = run_indent_tests(resources, tests, indent_unit, args.processes)
+    sys.exit(0 if report(tests, results) else 1)
@@ -1,5 +1,6 @@
 import os
 import re
+import time
 from difflib import ndiff
 
 import sublime
@@ -14,6 +15,25 @@ from Default.run_syntax_tests import show_panel_on_build, append
 ### ---------------------------------------------------------------------------
 
 
+# The stages of running a test that are timed, in the order they happen.
+_stages = ("load", "populate", "reindent", "compare")
+
+
+### ---------------------------------------------------------------------------
+
+
+class IndentTestPopulateCommand(sublime_plugin.TextCommand):
+    """
+    Replace the entire content of the view with the given text and select all
+    of it, ready to be reindented; this does in a single edit what would
+    otherwise take a command for every line.
+    """
+    def run(self, edit, characters):
+        self.view.replace(edit, sublime.Region(0, self.view.size()), characters)
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(0, self.view.size()))
+
+
 class RunIndentTestsCommand(sublime_plugin.WindowCommand):
     """
     A custom command that can be executed from a build system target for
@@ -23,9 +43,13 @@ class RunIndentTestsCommand(sublime_plugin.WindowCommand):
 
     The test inserts the data unindented into a view and then runs the reindent
     command to indent it, comparing the results to what the input file looked
-    like to verify the indent level.
+    like to verify the indent level. There is one view for each syntax, which
+    is reused for every test using that syntax in the same run.
     """
     def run(self, find_all=False, **kwargs):
+        self.test_views = {}
+        self.test_panels = []
+
         if not hasattr(self, 'output_view'):
             # Try not to call get_output_panel until the regexes are assigned
             self.output_view = self.window.create_output_panel('exec')
@@ -77,14 +101,20 @@ class RunIndentTestsCommand(sublime_plugin.WindowCommand):
 
         total_lines = 0
         failed_lines = 0
-
-        for test in tests:
-            lines, failures = self.run_indent_test(test)
-            total_lines += lines
-            if len(failures) > 0:
-                failed_lines += len(failures)
-                for line in failures:
-                    append(self.output_view, line + '\n')
+        timings = dict.fromkeys(_stages, 0.0)
+
+        try:
+            for test in tests:
+                lines, failures = self.run_indent_test(test, timings)
+                total_lines += lines
+                if len(failures) > 0:
+                    failed_lines += len(failures)
+                    for line in failures:
+                        append(self.output_view, line + '\n')
+        finally:
+            # Only the first panel is left behind for the user to look at.
+            for name in self.test_panels[1:]:
+                self.window.destroy_output_panel(name)
 
         if failed_lines > 0:
             message = 'FAILED: {} of {} lines in {} files failed\n'
@@ -94,30 +124,75 @@ class RunIndentTestsCommand(sublime_plugin.WindowCommand):
             params = (total_lines, len(tests))
 
         append(self.output_view, message.format(*params))
+        append(self.output_view, 'Timing: {}\n'.format(', '.join(
+            '{} {:.1f}ms'.format(stage, timings[stage] * 1000) for stage in _stages)))
         append(self.output_view, '[Finished]')
 
-    def run_indent_test(self, package_file):
-        syntax = self.syntax_for_file(package_file)
+    def test_view(self, syntax):
+        """
+        Return the view used to run tests for the given syntax, creating it
+        the first time it's used in a run. The view for the first syntax is
+        the output panel named indent_test; the others are unlisted, and are
+        destroyed at the end of the run.
+        """
+        view = self.test_views.get(syntax)
+        if view is not None and view.is_valid():
+            return view
+
+        # Every panel created gets a new name, so a syntax whose view has gone
+        # away can't end up sharing the panel of another syntax.
+        index = len(self.test_panels)
+        name = "indent_test" if index == 0 else "indent_test_{}".format(index + 1)
+        self.test_panels.append(name)
+
+        view = self.window.create_output_panel(name, index != 0)
+        view.assign_syntax(syntax)
+        view.settings().set("scratch", True)
+
+        self.test_views[syntax] = view
+        return view
+
+    def run_indent_test(self, package_file, timings):
+        """
+        Run the indentation test in the given file, returning a tuple of the
+        number of lines tested and a list of the lines that failed. The time
+        taken by each stage of the test is added to the given timings.
+        """
+        started = time.perf_counter()
+
+        input_file = sublime.load_resource(package_file)
+        syntax = self.syntax_for_content(input_file)
         if syntax is None:
             return (0, [])
 
-        input_file = sublime.load_resource(package_file)
         input_lines = input_file.splitlines()
+        stage_time = time.perf_counter()
+        timings["load"] += stage_time - started
 
-        view = self.window.create_output_panel("indent_test", False)
+        view = self.test_view(syntax)
+        view.run_command("indent_test_populate", {
+            "characters": "".join(line.lstrip() + "\n" for line in input_lines)
+        })
+        started, stage_time = stage_time, time.perf_counter()
+        timings["populate"] += stage_time - started
 
-        view.assign_syntax(syntax)
-        view.run_command("select_all")
-        view.run_command("left_delete")
-
-        for line in input_lines:
-            view.run_command("append", {"characters": line.lstrip() + "\n"})
-
-        view.run_command("select_all")
         view.run_command("reindent")
-
+        started, stage_time = stage_time, time.perf_counter()
+        timings["reindent"] += stage_time - started
+
+        try:
+            return self.compare(package_file, input_file, view)
+        finally:
+            timings["compare"] += time.perf_counter() - stage_time
+
+    def compare(self, package_file, input_file, view):
+        """
+        Compare the reindented content of the view to the input file that it
+        came from, returning a tuple of the number of lines tested and a list
+        of the lines that failed.
+        """
+        input_lines = input_file.splitlines()
         output_file = view.substr(sublime.Region(0, view.size()))
-        output_lines = output_file.splitlines()
 
         if input_file == output_file:
             return (len(input_lines), [])
@@ -138,7 +213,11 @@ class RunIndentTestsCommand(sublime_plugin.WindowCommand):
         return (len(input_lines), errors)
 
     def syntax_for_file(self, package_file):
-        first_line = sublime.load_resource(package_file).splitlines()[0]
+        return self.syntax_for_content(sublime.load_resource(package_file))
+
+    def syntax_for_content(self, content):
+        lines = content.splitlines()
+        first_line = lines[0] if lines else ""
         match = re.match('^.*INDENT TEST "(.*?)"', first_line)
         if not match:
             return None
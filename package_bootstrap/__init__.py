@@ -1,8 +1,6 @@
-### ---------------------------------------------------------------------------
-
+import sys
 
-from .core.startup import initialize
-from .sublime import commands, events
+from importlib import import_module
 
 __version_tuple = (1, 0, 0)
 __version__ = ".".join([str(num) for num in __version_tuple])
@@ -18,6 +16,17 @@ __all__ = [
     "version"
 ]
 
+# The attributes of the package that are only loaded the first time that they
+# are used, and the module that provides each one (and the name of the
+# attribute in that module, if it's not the module itself). Most packages that
+# use the dependency only ever call initialize() or version(), and so never
+# pay for loading the Sublime commands and event listeners.
+_lazy_attributes = {
+    "initialize": (".core.startup", "initialize"),
+    "commands":   (".sublime.commands", None),
+    "events":     (".sublime.events", None)
+}
+
 
 ### ---------------------------------------------------------------------------
 
@@ -31,4 +40,30 @@ def version():
     return __version_tuple
 
 
+def __getattr__(name):
+    """
+    Load one of the lazy attributes of the package the first time that it's
+    used; once loaded it's stored in the package, so this is only called once
+    for each of them.
+    """
+    if name not in _lazy_attributes:
+        raise AttributeError("module {mod!r} has no attribute {attr!r}".format(
+                             mod=__name__, attr=name))
+
+    module_name, attr = _lazy_attributes[name]
+    value = import_module(module_name, __name__)
+    if attr is not None:
+        value = getattr(value, attr)
+
+    globals()[name] = value
+    return value
+
+
+# Versions of Python older than 3.7 (such as the Python 3.3 plugin host) don't
+# call __getattr__ for a module, so everything has to be loaded right away.
+if sys.version_info < (3, 7):
+    for _name in _lazy_attributes:
+        __getattr__(_name)
+
+
 ### ---------------------------------------------------------------------------
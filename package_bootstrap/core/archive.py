@@ -0,0 +1,188 @@
+import os
+import json
+import zlib
+import struct
+
+from collections import namedtuple
+
+
+### ---------------------------------------------------------------------------
+
+
+# The name of the file inside of the bootstrapped package that records the
+# content hash of every other file in the package. It's not a resource type
+# that Sublime knows about, so Sublime ignores it.
+manifest_name = "bootstrap_manifest.json"
+
+# The compression methods that entries can use; these are the same values as
+# the constants in zipfile, which is only imported when an existing package
+# needs to be read, since it's slow to import and isn't needed to check the
+# fingerprint of a package at startup.
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Every entry is given the same fixed date and time (the earliest that a zip
+# file can represent), so that building the same files always produces the
+# same package.
+_dos_date = (1 << 5) | 1
+_dos_time = 0
+
+_local_header = struct.Struct("<4s2B4HL2L2H")
+_central_header = struct.Struct("<4s4B4HL2L5H2L")
+_end_record = struct.Struct("<4s4H2LH")
+
+# The fingerprint is stored as the comment of the package, which is at the
+# very end of the file; this is the most that is read when looking for it.
+_max_comment = 1024
+
+
+### ---------------------------------------------------------------------------
+
+
+# An entry for a package file, with its data already compressed (or not, as
+# the method dictates), ready to be written into an archive.
+RawEntry = namedtuple("RawEntry", "name method crc data size")
+
+
+def content_hash(data):
+    """
+    Return the content hash used in the manifest for the given file data.
+    """
+    import hashlib
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress_entry(name, data, method=ZIP_DEFLATED, level=6):
+    """
+    Create a RawEntry for a file with the given name and content, compressed
+    with the given method (ZIP_DEFLATED or ZIP_STORED) and compression level.
+    """
+    if method == ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        packed = compressor.compress(data) + compressor.flush()
+    else:
+        packed = data
+
+    return RawEntry(name, method, zlib.crc32(data) & 0xffffffff, packed, len(data))
+
+
+def manifest_entry(manifest):
+    """
+    Create a RawEntry for the manifest file that records the given manifest,
+    a dictionary that maps the name of every file in the package to its
+    content hash.
+    """
+    data = json.dumps({"files": manifest}, indent=4, sort_keys=True)
+    return compress_entry(manifest_name, data.encode("utf-8"))
+
+
+### ---------------------------------------------------------------------------
+
+
+def read_package(package):
+    """
+    Read the package with the given name, returning a tuple of the manifest
+    stored in it and a dictionary of RawEntry objects that holds the data of
+    each file, still compressed, so that it can be copied into a new package
+    without having to compress it again.
+
+    The manifest is None if the package does not exist, can't be read, or
+    does not contain a manifest.
+    """
+    from zipfile import ZipFile, BadZipFile
+
+    try:
+        entries = {}
+        with ZipFile(package) as zFile, open(package, "rb") as raw:
+            for info in zFile.infolist():
+                if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+                    return (None, {})
+
+                raw.seek(info.header_offset)
+                header = _local_header.unpack(raw.read(_local_header.size))
+                raw.seek(header[-2] + header[-1], os.SEEK_CUR)
+
+                entries[info.filename] = RawEntry(info.filename,
+                                                  info.compress_type,
+                                                  info.CRC,
+                                                  raw.read(info.compress_size),
+                                                  info.file_size)
+
+            manifest = json.loads(zFile.read(manifest_name).decode("utf-8"))
+            return (manifest["files"], entries)
+
+    except (OSError, BadZipFile, KeyError, ValueError, struct.error):
+        return (None, {})
+
+
+def read_fingerprint(package):
+    """
+    Read the fingerprint stored in the package with the given name, returning
+    None if there isn't one. This only reads a small amount of data from the
+    end of the package, and so is much quicker than opening it as a zip file.
+    """
+    try:
+        with open(package, "rb") as file:
+            size = file.seek(0, os.SEEK_END)
+            file.seek(max(0, size - _end_record.size - _max_comment))
+            tail = file.read()
+
+        pos = tail.rfind(b"PK\x05\x06")
+        if pos < 0 or len(tail) - pos < _end_record.size:
+            return None
+
+        start = pos + _end_record.size
+        length = _end_record.unpack_from(tail, pos)[-1]
+        return json.loads(tail[start:start + length].decode("utf-8"))
+
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def write_package(package, entries, fingerprint=None):
+    """
+    Write a package with the given name that contains the given RawEntry
+    objects in the order given. This does no compression, which allows
+    entries to be compressed ahead of time (or copied from another package).
+
+    The fingerprint, if given, is a small dictionary that is stored in the
+    package so that it can be read back with read_fingerprint().
+    """
+    comment = b""
+    if fingerprint is not None:
+        comment = json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+        if len(comment) > _max_comment:
+            raise ValueError("package fingerprint is too large")
+
+    central = []
+    with open(package, "wb") as file:
+        for entry in entries:
+            name = entry.name.replace(os.sep, "/").encode("utf-8")
+            offset = file.tell()
+
+            # Flag bit 11 marks the name as being UTF-8 encoded.
+            fields = (0x800, entry.method, _dos_time, _dos_date, entry.crc,
+                      len(entry.data), entry.size, len(name))
+
+            file.write(_local_header.pack(b"PK\x03\x04", 20, 0, *(fields + (0,))))
+            file.write(name)
+            file.write(entry.data)
+
+            # The entries are marked as having been created on Unix, so that
+            # the external attributes give them regular file permissions.
+            central.append(_central_header.pack(b"PK\x01\x02", 20, 3, 20, 0,
+                                                *(fields + (0, 0, 0, 0, 0o644 << 16, offset)))
+                           + name)
+
+        start = file.tell()
+        for record in central:
+            file.write(record)
+
+        file.write(_end_record.pack(b"PK\x05\x06", 0, 0, len(central),
+                                    len(central), file.tell() - start,
+                                    start, len(comment)))
+        file.write(comment)
+
+
+### ---------------------------------------------------------------------------
@@ -2,47 +2,53 @@ import sublime
 
 import os
 import re
+import json
 import codecs
-import textwrap
-from zipfile import ZipFile
+import filecmp
 
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
-from os.path import join, dirname, normpath, relpath
+from os.path import join, relpath
 from importlib import __import__ as do_import
 
+from .common import log, bootstrap_packages, bootloader, package_path, resource_path
+from .archive import ZIP_STORED, ZIP_DEFLATED
+from .archive import content_hash, compress_entry, manifest_entry
+from .archive import read_package, read_fingerprint, write_package
+from .views import ViewIndex, saved_settings
+from .trace import StartupTrace
+
 
 ### ---------------------------------------------------------------------------
 
 
-# These name the bootstrap package that we use to give Sublime access to our
-# resources and commands, and the base name of the file within that package
-# that is responsible for loading the commands into Sublime when the package
-# is loaded.
-bootstrap_pkg = "1_my_package"
-bootloader = "bootstrap"
+# These control how files are compressed as they're added to the bootstrap
+# package; the zlib compression level to use, the number of files to compress
+# at once, and the extensions of files that are stored without compression,
+# because they're already compressed or load faster that way.
+compress_level = 6
+compress_workers = 4
+stored_extensions = (".png", ".gif", ".jpg", ".jpeg", ".zip", ".gz")
 
 
 ### ---------------------------------------------------------------------------
 
 
-def log(msg, *args, dialog=False, error=False, **kwargs):
+def package_fingerprint(manifest):
     """
-    Generate a message to the console and optionally as either a message or
-    error dialog. The message will be formatted and dedented before being
-    displayed, and will be prefixed with its origin.
+    Return the fingerprint to be stored in a system bootstrap package with the
+    given manifest; this records the version of the dependency that created
+    the package, which is what is checked at startup, along with the
+    compression level used to create it.
     """
-    msg = textwrap.dedent(msg.format(*args, **kwargs)).strip()
-
-    if error:
-        print("my_package error:")
-        return sublime.error_message(msg)
+    from package_bootstrap import __version__
 
-    for line in msg.splitlines():
-        print("my_package: {msg}".format(msg=line))
-
-    if dialog:
-        sublime.message_dialog(msg)
+    return {
+        "version": __version__,
+        "manifest": content_hash(json.dumps(manifest, sort_keys=True).encode("utf-8")),
+        "level": compress_level
+    }
 
 
 ### ---------------------------------------------------------------------------
@@ -51,24 +57,33 @@ def log(msg, *args, dialog=False, error=False, **kwargs):
 class BootstrapThread(Thread):
     """
     Spawns a background thread that will create or update the my_package
-    bootstrap package.
+    bootstrap packages; all of the registered packages unless a list of
+    packages is given. Each step of the bootstrap is recorded in the given
+    startup trace (if any), which is finished when the bootstrap is done.
     """
-    def __init__(self):
+    def __init__(self, packages=None, trace=None):
         super().__init__()
         self.settings = sublime.load_settings("Preferences.sublime-settings")
+        self.packages = list(bootstrap_packages if packages is None else packages)
+        self.trace = StartupTrace() if trace is None else trace
+        self.view_index = ViewIndex()
 
 
-    def enable_package(self, reenable_resources):
+    def enable_packages(self, packages, reenable_resources):
         """
-        Enables the system bootstrap package (if it exists) by ensuring that
-        it is not in the list of ignored packages and then restoring any
-        resources that were unloaded back to the views that were using them.
+        Enables the given system bootstrap packages (if they exist) by
+        ensuring that they are not in the list of ignored packages and then
+        restoring any resources that were unloaded back to the views that were
+        using them.
+
+        Every change to the ignored packages makes Sublime reload packages, so
+        they are all removed from the list with a single change.
         """
         ignored_packages = self.settings.get("ignored_packages", [])
+        remaining = [pkg for pkg in ignored_packages if pkg not in packages]
 
-        if bootstrap_pkg in ignored_packages:
-            ignored_packages.remove(bootstrap_pkg)
-            self.settings.set("ignored_packages", ignored_packages)
+        if remaining != ignored_packages:
+            self.settings.set("ignored_packages", remaining)
 
         # Enable resources after a short delay to ensure that Sublime has had a
         # change to re-index them.
@@ -76,19 +91,21 @@ class BootstrapThread(Thread):
             sublime.set_timeout_async(lambda: self.enable_resources())
 
 
-    def disable_package(self):
+    def disable_packages(self, packages):
         """
-        Disables the system bootstrap package (if it exists) by ensuring that
-        none of the resources that it provides are currently in use and then
-        adding it to the list of ignored packages so that Sublime will unload
-        it.
+        Disables the given system bootstrap packages (if they exist) by
+        ensuring that none of the resources that they provide are currently in
+        use and then adding them to the list of ignored packages so that
+        Sublime will unload them; as above, this is a single change.
         """
-        self.disable_resources()
+        for pkg in packages:
+            self.disable_resources(pkg)
 
         ignored_packages = self.settings.get("ignored_packages", [])
-        if bootstrap_pkg not in ignored_packages:
-            ignored_packages.append(bootstrap_pkg)
-            self.settings.set("ignored_packages", ignored_packages)
+        missing = [pkg for pkg in packages if pkg not in ignored_packages]
+
+        if missing:
+            self.settings.set("ignored_packages", ignored_packages + missing)
 
 
     def enable_resources(self):
@@ -96,33 +113,51 @@ class BootstrapThread(Thread):
         Enables all resources being provided by the system boostrap package by
         restoring the state that was saved when the resources were disabled.
         """
-        for window in sublime.windows():
-            for view in window.views():
-                s = view.settings()
-                old_syntax = s.get("_mp_boot_syntax", None)
-                if old_syntax is not None:
-                    s.set("syntax", old_syntax)
-                    s.erase("_mp_boot_syntax")
-
-
-    def disable_resources(self):
+        for view in self.view_index.views_saved():
+            s = view.settings()
+            for setting, saved in saved_settings.items():
+                old_value = s.get(saved, None)
+                if old_value is None:
+                    continue
+
+                # A color scheme may have been inherited from the preferences
+                # rather than being set on the view, so it's only put back if
+                # removing the temporary one doesn't already restore it.
+                s.erase(setting)
+                if s.get(setting) != old_value:
+                    s.set(setting, old_value)
+                s.erase(saved)
+
+
+    def disable_resources(self, pkg):
         """
-        Disables all resources being provided by the system bootstrap package
-        by saving the state of items that are using them and then reverting
-        them to temporary defaults.
-        """
-        prefix = "Packages/{pkg}/".format(pkg=bootstrap_pkg)
+        Disables all resources being provided by the given system bootstrap
+        package by saving the state of items that are using them and then
+        reverting them to temporary defaults.
 
-        # TODO if the package also contains a custom color scheme, this should
-        # also temporarily reset the color scheme back to defaults and then
-        # restore them later.
-        for window in sublime.windows():
-            for view in window.views():
-                s = view.settings()
-                syntax = s.get("syntax")
-                if syntax.startswith(prefix):
-                    s.set("_mp_boot_syntax", syntax)
-                    s.set("syntax", "Packages/Text/Plain text.tmLanguage")
+        The views to change are found using the view index, so the open views
+        are only looked at once no matter how many packages are disabled, and
+        only the views that are actually using the resources are touched.
+        """
+        prefix = "Packages/{pkg}/".format(pkg=pkg)
+        defaults = {
+            "syntax": "Packages/Text/Plain text.tmLanguage",
+            "color_scheme": ("Monokai.sublime-color-scheme" if int(sublime.version()) >= 3150
+                             else "Packages/Color Scheme - Default/Monokai.tmTheme")
+        }
+
+        for view in self.view_index.views_using(pkg):
+            s = view.settings()
+            for setting, saved in saved_settings.items():
+                value = s.get(setting)
+                if not isinstance(value, str):
+                    continue
+
+                if value.startswith(prefix) or (setting == "color_scheme" and
+                        self.view_index.resource_packages(value) == set([pkg])):
+                    s.set(saved, value)
+                    s.set(setting, defaults[setting])
+                    self.view_index.mark_saved(view)
 
 
     def create_boot_loader(self, stub_loader_name):
@@ -148,71 +183,247 @@ class BootstrapThread(Thread):
             raise
 
 
+    def collect_files(self, res_path):
+        """
+        Gather up the files in the given resource folder that should be added
+        to the system bootstrap package, returning a list of tuples of the name
+        each file should have in the package and the file it comes from, in a
+        consistent order.
+        """
+        files = []
+
+        for (path, dirs, names) in os.walk(res_path):
+            # Any bytecode in the resource folder is from importing the files
+            # in place; it's never wanted in the package.
+            dirs[:] = sorted(name for name in dirs if name != "__pycache__")
+            rPath = relpath(path, res_path) if path != res_path else ""
+
+            for file in sorted(names):
+                real_file = join(res_path, path, file)
+                archive_file = join(rPath, file).replace(os.sep, "/")
+
+                if archive_file.endswith(".sublime-ignored"):
+                    archive_file = archive_file[:-len(".sublime-ignored")]
+
+                files.append((archive_file, real_file))
+
+        return files
+
+
+    def prepare_entry(self, archive_file, real_file, reuse):
+        """
+        Load the content of a file that is to be added to the system bootstrap
+        package and create the entry for it, returning a tuple of the content
+        hash and the entry.
+
+        Entries in the reuse dictionary (which maps file names to a tuple of
+        content hash and entry) are used instead of creating a new one when
+        the content hash matches. This is called from several threads at once;
+        reading and compressing the data both release the GIL.
+        """
+        if archive_file == "{file}.py".format(file=bootloader):
+            content = self.create_boot_loader(real_file).encode("utf-8")
+        else:
+            with open(real_file, "rb") as handle:
+                content = handle.read()
+
+        digest = content_hash(content)
+        method = ZIP_STORED if archive_file.endswith(stored_extensions) else ZIP_DEFLATED
+
+        old_digest, old_entry = reuse.get(archive_file, (None, None))
+        if old_digest == digest and old_entry.method == method:
+            return (digest, old_entry)
+
+        return (digest, compress_entry(archive_file, content, method, compress_level))
+
+
     def create_bootstrap_package(self, package, res_path):
         """
         Perform the task of actually creating the system bootstrap package from
-        files in the given resource folder into the provided package.
+        files in the given resource folder, into a temporary file alongside the
+        provided package. Returns the name of the temporary file, or None if
+        the existing package is already identical to what would be created.
+
+        The package contains a manifest of the content hash of every file, so
+        if the existing package already has the same files with the same
+        content, nothing is created; otherwise, any files that are unchanged
+        are copied from the existing package without being compressed again.
+
+        Files are loaded and compressed in a pool of threads, and then written
+        to the package in a consistent order.
         """
+        tmp_package = package + ".tmp"
+        step = os.path.splitext(os.path.basename(package))[0] + " {step}"
         try:
-            success = True
-            boot_file = "{file}.py".format(file=bootloader)
+            with self.trace.phase(step.format(step="walk")):
+                files = self.collect_files(res_path)
+
+            # Entries from the existing package can only be reused if they
+            # were compressed the same way.
+            with self.trace.phase(step.format(step="read")):
+                old_manifest, old_entries = read_package(package)
+                old_fingerprint = read_fingerprint(package) or {}
+            reuse = {}
+            if old_manifest and old_fingerprint.get("level") == compress_level:
+                reuse = {name: (old_manifest[name], old_entries[name])
+                         for name in old_manifest if name in old_entries}
+
+            with self.trace.phase(step.format(step="compress")):
+                with ThreadPoolExecutor(max_workers=compress_workers) as pool:
+                    results = list(pool.map(lambda file: self.prepare_entry(file[0], file[1], reuse),
+                                            files))
+
+            manifest = {name: digest for (name, real_file), (digest, entry) in zip(files, results)}
+            fingerprint = package_fingerprint(manifest)
+            if old_manifest == manifest and old_fingerprint == fingerprint:
+                return None
+
+            with self.trace.phase(step.format(step="write")):
+                entries = [entry for digest, entry in results]
+                entries.append(manifest_entry(manifest))
+                write_package(tmp_package, entries, fingerprint)
+
+                same = os.path.isfile(package) and filecmp.cmp(package, tmp_package, shallow=False)
+
+            if same:
+                os.remove(tmp_package)
+                return None
+
+            return tmp_package
 
-            with ZipFile(package, 'w') as zFile:
-                for (path, dirs, files) in os.walk(res_path):
-                    rPath = relpath(path, res_path) if path != res_path else ""
+        except:
+            if os.path.exists(tmp_package):
+                os.remove(tmp_package)
+            raise
 
-                    for file in files:
-                        real_file = join(res_path, path, file)
-                        archive_file = join(rPath, file)
 
-                        if archive_file.endswith(".sublime-ignored"):
-                            archive_file = archive_file[:-len(".sublime-ignored")]
+    def install_package(self, tmp_package, package):
+        """
+        Put the newly created package into place, replacing the existing one
+        (if any). Returns True on success.
 
-                        if archive_file == boot_file:
-                            content = self.create_boot_loader(real_file)
-                            zFile.writestr(archive_file, content)
-                        else:
-                            zFile.write(real_file, archive_file)
+        If the package can't be replaced (such as when it's locked on Windows),
+        the existing package is left as it is; the caller removes the new one.
+        """
+        try:
+            os.replace(tmp_package, package)
+            return True
 
         except Exception as err:
-            success = False
             log("Bootstrap error: {reason}", reason=str(err))
-            if os.path.exists(package):
-                os.remove(package)
 
-        return success
+        return False
 
 
-    def run(self):
+    def remove_temporary(self, tmp_package):
         """
-        Creates or updates the system bootstrap package by packaging up the
-        contents of the resource directory.
+        Remove a temporary package that wasn't put into place, if it still
+        exists; failing to remove it is logged, but is otherwise harmless.
         """
-        self.disable_package()
+        try:
+            if os.path.exists(tmp_package):
+                os.remove(tmp_package)
+        except OSError as err:
+            log("Unable to remove {file}: {reason}", file=tmp_package, reason=str(err))
+
 
-        res_path = normpath(join(dirname(__file__), "..", bootstrap_pkg))
-        package = join(sublime.installed_packages_path(), bootstrap_pkg +
-                            ".sublime-package")
+    def build_package(self, pkg):
+        """
+        Create the new version of the given system bootstrap package, returning
+        a tuple of the name of the temporary file that holds it (None if the
+        existing package is already up to date) and whether it was created
+        without error.
+        """
+        res_path = resource_path(pkg)
+        package = package_path(pkg)
 
         prefix = os.path.commonprefix([res_path, package])
         log("Bootstraping {path} to {pkg}",
             path=res_path[len(prefix):],
             pkg=package[len(prefix):])
 
-        pkg_existed = os.path.isfile(package)
-        success = self.create_bootstrap_package(package, res_path)
+        try:
+            return (self.create_bootstrap_package(package, res_path), True)
+        except Exception as err:
+            log("Bootstrap error in {pkg}: {reason}", pkg=pkg, reason=str(err))
+            return (None, False)
+
+
+    def run(self):
+        """
+        Creates or updates the system bootstrap packages, finishing the trace
+        of the startup once that's done.
+        """
+        try:
+            self.bootstrap()
+        finally:
+            self.trace.finish()
 
-        self.enable_package(success)
 
-        if not success:
+    def bootstrap(self):
+        """
+        Creates or updates the system bootstrap packages by packaging up the
+        contents of their resource directories.
+
+        The new packages are all created (at the same time) before anything
+        else happens, and the packages that are the same as the existing ones
+        are left alone. The rest are disabled together while the new packages
+        are swapped into place, and then enabled again together, so that the
+        ignored packages only change twice no matter how many packages there
+        are.
+        """
+        if not self.packages:
+            return
+
+        with ThreadPoolExecutor(max_workers=len(self.packages)) as pool:
+            results = list(pool.map(self.build_package, self.packages))
+
+        built = {pkg: tmp for pkg, (tmp, ok) in zip(self.packages, results) if tmp is not None}
+        failed = [pkg for pkg, (tmp, ok) in zip(self.packages, results) if not ok]
+
+        for pkg, (tmp, ok) in zip(self.packages, results):
+            if ok and tmp is None:
+                log("{pkg} is already up to date", pkg=pkg)
+
+        pkg_existed = False
+        if built:
+            pkg_existed = any(os.path.isfile(package_path(pkg)) for pkg in built)
+
+            # The packages must always be enabled again, whatever happens,
+            # or they stay ignored; the views they were taken away from get
+            # their resources back even if no package could be installed,
+            # since the existing packages are then still there to provide
+            # them.
+            installed = []
+            try:
+                with self.trace.phase("disable"):
+                    self.disable_packages(list(built))
+                with self.trace.phase("install"):
+                    for pkg in built:
+                        if self.install_package(built[pkg], package_path(pkg)):
+                            installed.append(pkg)
+            finally:
+                for pkg in built:
+                    if pkg not in installed:
+                        failed.append(pkg)
+                        self.remove_temporary(built[pkg])
+
+                with self.trace.phase("enable"):
+                    self.enable_packages(list(built), True)
+
+        if failed:
             return log(
                 """
-                An error was encountered while updating my_package.
+                An error was encountered while updating my_package
+                ({packages}).
 
                 Please check the console to see what went wrong.
                 my_package will not be available until the problem
                 is resolved.
-                """, error=True)
+                """, packages=", ".join(failed), error=True)
+
+        if not built:
+            return
 
         if pkg_existed:
             log(
@@ -0,0 +1,63 @@
+import sublime
+
+import textwrap
+
+from os.path import join, dirname, normpath
+
+
+### ---------------------------------------------------------------------------
+
+
+# These name the bootstrap package that we use to give Sublime access to our
+# resources and commands, and the base name of the file within that package
+# that is responsible for loading the commands into Sublime when the package
+# is loaded.
+bootstrap_pkg = "1_my_package"
+bootloader = "bootstrap"
+
+# The registry of all of the packages that are bootstrapped. Each one is built
+# from the folder of the same name alongside the core folder, and they're all
+# checked and bootstrapped together. The package named above should always be
+# in this list, since it's the one that loads the commands; any others are just
+# extra resources (syntaxes, color schemes and so on).
+bootstrap_packages = [bootstrap_pkg]
+
+
+### ---------------------------------------------------------------------------
+
+
+def package_path(pkg=bootstrap_pkg):
+    """
+    Return the full path to the given system bootstrap package.
+    """
+    return join(sublime.installed_packages_path(), pkg + ".sublime-package")
+
+
+def resource_path(pkg=bootstrap_pkg):
+    """
+    Return the full path to the folder that holds the resources of the given
+    system bootstrap package.
+    """
+    return normpath(join(dirname(__file__), "..", pkg))
+
+
+def log(msg, *args, dialog=False, error=False, **kwargs):
+    """
+    Generate a message to the console and optionally as either a message or
+    error dialog. The message will be formatted and dedented before being
+    displayed, and will be prefixed with its origin.
+    """
+    msg = textwrap.dedent(msg.format(*args, **kwargs)).strip()
+
+    if error:
+        print("my_package error:")
+        return sublime.error_message(msg)
+
+    for line in msg.splitlines():
+        print("my_package: {msg}".format(msg=line))
+
+    if dialog:
+        sublime.message_dialog(msg)
+
+
+### ---------------------------------------------------------------------------
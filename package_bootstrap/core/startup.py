@@ -1,68 +1,21 @@
 import sublime
 
 import os
+import time
 
-from .bootstrapper import log, bootstrap_pkg, bootloader, BootstrapThread
+from .archive import read_fingerprint
+from .common import log, bootstrap_packages, package_path
+from .trace import StartupTrace
 
 
 ### ---------------------------------------------------------------------------
 
 
-def _should_bootstrap(settings):
+def _can_bootstrap(settings, ignored_packages, pkg_name):
     """
-    Check to see if the my_package bootstrap package needs to be
-    created/updated or not. This checks both for the existence of the package
-    as well as for when the bootstrapped version is different from ours.
-    """
-    # For debugging/testing/troubleshooting purposes, this allows you to set a
-    # setting that forces the bootstrap to occur, even if it doesn't need to be
-    # done.
-    if settings.get("my_package_force_bootstrap", False):
-        log("bootstrap forced; skipping check")
-        return True
-
-    try:
-        from importlib import __import__ as do_import
-        from package_boostrap import __version__ as mp_sys_version
-
-        mod = do_import("{pkg}.{file}".format(
-                        pkg=bootstrap_pkg, file=bootloader),
-                        fromlist=("__version__"))
-        bootstrapped_version = mod.__dict__["__version__"]
-
-        if bootstrapped_version == mp_sys_version:
-            msg = "my_package {sys} up to date"
-        else:
-            msg = "upgrading my_package from {boot} to {sys}"
-
-        log(msg, sys=mp_sys_version, boot=bootstrapped_version)
-        return not bootstrapped_version == mp_sys_version
-
-    except:
-        log("my_package system package is missing ({pkg_name}); bootstrapping",
-            pkg_name=bootstrap_pkg)
-
-    return True
-
-
-def initialize():
+    Check to see if the given my_package bootstrap package is in a state where
+    it can be bootstrapped, complaining if it's not.
     """
-    Ensures that the my_package resource package that provides the syntax and
-    other Sublime resources exists and is up to date; does nothing if this has
-    already been called once.
-
-    This *must* be invoked by all packages that are using the dependency and
-    *must* be invoked after plugin_loaded() has been called, as it requires the 
-    Sublime API to be available.
-    """
-    if hasattr(initialize, "complete"):
-        return
-
-    initialize.complete = True
-
-    settings = sublime.load_settings("Preferences.sublime-settings")
-    ignored_packages = settings.get("ignored_packages", [])
-
     # Checks to see if the bootstrapped package is in the list of ignored
     # packages and complains if it is unless the user has also purposefully set
     # a setting telling us not to.
@@ -71,12 +24,13 @@ def initialize():
     # confusion on the behalf of the user, since they technically did not
     # install the bootstrapped package directly and might not know what it's
     # for.
-    if bootstrap_pkg in ignored_packages:
+    if pkg_name in ignored_packages:
         if settings.get("my_package_ignore_disabled", False):
-            return log("{pkg_name} package ignored; my_package disabled",
-                        pkg_name=bootstrap_pkg)
+            log("{pkg_name} package ignored; my_package disabled",
+                 pkg_name=pkg_name)
+            return False
 
-        return log(
+        log(
             """
             The {pkg_name} package is currently disabled.
 
@@ -87,7 +41,8 @@ def initialize():
             set the value of the 'my_package_ignore_disabled'
             setting to True in your Preferences.sublime-settings
             file to remove this warning message at startup.
-            """, pkg_name=bootstrap_pkg, error=True)
+            """, pkg_name=pkg_name, error=True)
+        return False
 
     # Checks to see if the bootstrapped package is unpacked and complains if it
     # is unless the user has also purposefully set a setting telling us not to.
@@ -95,13 +50,14 @@ def initialize():
     # If the bootstrapped package is overridden by someone that doesn't
     # understand the ramifications, they will block themselves from getting
     # updates when  the dependency is updated.
-    pkg_folder = os.path.join(sublime.packages_path(), bootstrap_pkg)
+    pkg_folder = os.path.join(sublime.packages_path(), pkg_name)
     if os.path.lexists(pkg_folder):
         if settings.get("my_package_allow_unpacked", False):
-            return log("{pkg_name} package is unpacked; issues may arise",
-                        pkg_name=bootstrap_pkg)
+            log("{pkg_name} package is unpacked; issues may arise",
+                 pkg_name=pkg_name)
+            return False
 
-        return log(
+        log(
             """
             The {pkg_name} package is unpacked.
 
@@ -111,10 +67,91 @@ def initialize():
 
             Please remove the {pkg_name} folder from
             the Packages folder and restart sublime.
-            """, pkg_name=bootstrap_pkg, error=True)
+            """, pkg_name=pkg_name, error=True)
+        return False
+
+    return True
+
+
+def _should_bootstrap(settings, pkg_name):
+    """
+    Check to see if the given my_package bootstrap package needs to be
+    created/updated or not. This checks both for the existence of the package
+    as well as for when the bootstrapped version is different from ours.
+    """
+    # For debugging/testing/troubleshooting purposes, this allows you to set a
+    # setting that forces the bootstrap to occur, even if it doesn't need to be
+    # done.
+    if settings.get("my_package_force_bootstrap", False):
+        log("bootstrap forced for {pkg_name}; skipping check", pkg_name=pkg_name)
+        return True
+
+    # The version of the dependency that created the bootstrapped package is
+    # stored in a fingerprint at the end of the package, which is read without
+    # loading the package (or anything that it imports).
+    from package_bootstrap import __version__ as mp_sys_version
+
+    fingerprint = read_fingerprint(package_path(pkg_name))
+    if not isinstance(fingerprint, dict) or "version" not in fingerprint:
+        log("my_package system package is missing ({pkg_name}); bootstrapping",
+            pkg_name=pkg_name)
+        return True
+
+    bootstrapped_version = fingerprint["version"]
+    if bootstrapped_version == mp_sys_version:
+        msg = "my_package {sys} up to date ({pkg_name})"
+    else:
+        msg = "upgrading my_package from {boot} to {sys} ({pkg_name})"
+
+    log(msg, sys=mp_sys_version, boot=bootstrapped_version, pkg_name=pkg_name)
+    return not bootstrapped_version == mp_sys_version
+
+
+def initialize():
+    """
+    Ensures that the my_package resource package that provides the syntax and
+    other Sublime resources exists and is up to date; does nothing if this has
+    already been called once.
+
+    This *must* be invoked by all packages that are using the dependency and
+    *must* be invoked after plugin_loaded() has been called, as it requires the 
+    Sublime API to be available.
+    """
+    if hasattr(initialize, "complete"):
+        return
+
+    initialize.complete = True
+
+    # Tracing is only enabled by a setting, so loading the settings is timed
+    # from here and recorded once the trace exists.
+    started = time.perf_counter()
+    settings = sublime.load_settings("Preferences.sublime-settings")
+    ignored_packages = settings.get("ignored_packages", [])
+
+    trace = StartupTrace.from_settings(settings, started)
+    trace.record("settings", started)
+
+    # The bootstrap is done for all of the packages that need it at once, so
+    # that the ignored packages only need to change twice.
+    packages = []
+    for pkg_name in bootstrap_packages:
+        with trace.phase("{pkg} checks".format(pkg=pkg_name)):
+            usable = _can_bootstrap(settings, ignored_packages, pkg_name)
+
+        with trace.phase("{pkg} version".format(pkg=pkg_name)):
+            if usable and _should_bootstrap(settings, pkg_name):
+                packages.append(pkg_name)
+
+    if not packages:
+        return trace.finish()
+
+    # The bootstrapper (and everything it needs to build a package) is only
+    # loaded when a bootstrap is actually needed, which is rarely. The trace
+    # is finished by the bootstrap thread, once it's done.
+    with trace.phase("import bootstrapper"):
+        from .bootstrapper import BootstrapThread
 
-    if _should_bootstrap(settings):
-        BootstrapThread().start()
+    BootstrapThread(packages, trace).start()
 
 
 ### ---------------------------------------------------------------------------
@@ -0,0 +1,130 @@
+import sublime
+
+import os
+import json
+import time
+
+from threading import Lock, current_thread
+from contextlib import contextmanager
+
+from .common import log
+
+
+### ---------------------------------------------------------------------------
+
+
+class StartupTrace():
+    """
+    Record how long each phase of the startup check (and of the bootstrap, if
+    one happens) takes, so that a slow start of Sublime can be attributed to
+    the dependency or ruled out.
+
+    Tracing is opt in; when it's not enabled, phases are not timed and nothing
+    is reported. Phases can be recorded from several threads at once, since
+    packages are bootstrapped at the same time.
+    """
+    def __init__(self, enabled=False, trace_file=None, started=None):
+        self.enabled = enabled
+        self.trace_file = trace_file
+        self.started = time.perf_counter() if started is None else started
+        self.finished = False
+        self.phases = []
+        self.lock = Lock()
+
+
+    @classmethod
+    def from_settings(cls, settings, started=None):
+        """
+        Create a trace as configured by the 'my_package_trace' setting, which
+        is either a boolean or the name of a file to write the trace to as
+        JSON; relative names are relative to the User package.
+        """
+        setting = settings.get("my_package_trace", False)
+        if not isinstance(setting, str):
+            return cls(bool(setting), started=started)
+
+        trace_file = os.path.expanduser(setting)
+        if not os.path.isabs(trace_file):
+            trace_file = os.path.join(sublime.packages_path(), "User", trace_file)
+
+        return cls(True, trace_file, started)
+
+
+    def record(self, name, started):
+        """
+        Record a phase with the given name, which started at the given time
+        (as returned by time.perf_counter()) and ended now.
+        """
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        with self.lock:
+            self.phases.append({
+                "phase": name,
+                "start": round(started - self.started, 6),
+                "seconds": round(now - started, 6),
+                "thread": current_thread().name
+            })
+
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the code run in the body of a with statement as the named phase.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+
+    def as_dict(self):
+        """
+        Return the trace collected so far as a dictionary that can be
+        serialized as JSON.
+        """
+        with self.lock:
+            return {
+                "seconds": round(time.perf_counter() - self.started, 6),
+                "phases": list(self.phases)
+            }
+
+
+    def summary(self, trace):
+        """
+        Return the single line that summarizes the given trace (as returned by
+        as_dict()) on the console.
+        """
+        phases = ", ".join("{name} {ms:.1f}ms".format(name=phase["phase"],
+                                                       ms=phase["seconds"] * 1000)
+                           for phase in trace["phases"])
+        return "startup took {ms:.1f}ms ({phases})".format(ms=trace["seconds"] * 1000,
+                                                           phases=phases)
+
+
+    def finish(self):
+        """
+        Report the trace, if tracing is enabled: a summary line on the console
+        and, when there is a trace file, the whole trace as JSON. This is done
+        once, when everything the startup started is complete.
+        """
+        with self.lock:
+            if not self.enabled or self.finished:
+                return
+            self.finished = True
+
+        trace = self.as_dict()
+        log("{summary}", summary=self.summary(trace))
+
+        if self.trace_file is not None:
+            try:
+                with open(self.trace_file, "w") as file:
+                    json.dump(trace, file, indent=4)
+            except OSError as err:
+                log("unable to write trace file {file}: {reason}",
+                    file=self.trace_file, reason=str(err))
+
+
+### ---------------------------------------------------------------------------
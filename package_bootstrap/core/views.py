@@ -0,0 +1,114 @@
+import sublime
+
+
+### ---------------------------------------------------------------------------
+
+
+# The view settings that hold resources that could come from the bootstrapped
+# package, and the settings used to save their values while the package is
+# disabled.
+resource_settings = ("syntax", "color_scheme")
+saved_settings = {
+    "syntax": "_mp_boot_syntax",
+    "color_scheme": "_mp_boot_color_scheme"
+}
+
+
+### ---------------------------------------------------------------------------
+
+
+class ViewIndex():
+    """
+    Keep track of which views are using resources (syntaxes and color schemes)
+    from which packages, so that the views using the resources of a package
+    can be found without having to look at every view in every window again.
+
+    The index is built by looking at every open view once, the first time
+    that it's used. Nothing keeps it up to date after that, so an index is
+    only meant to be used for a single bootstrap; the views that the bootstrap
+    changes are recorded in it as they're changed, so that putting them back
+    doesn't need to look at every view a second time.
+    """
+    def __init__(self):
+        self.primed = False
+        self.by_package = {}
+        self.saved = set()
+        self.schemes = {}
+
+
+    def resource_packages(self, resource):
+        """
+        Return the set of packages that a resource could be coming from. Color
+        schemes can be given as just a file name, in which case every package
+        that contains a file with that name is included.
+        """
+        if not isinstance(resource, str) or not resource:
+            return set()
+
+        if resource.startswith("Packages/"):
+            return set([resource.split("/")[1]])
+
+        if resource not in self.schemes:
+            self.schemes[resource] = set(name.split("/")[1]
+                                     for name in sublime.find_resources(resource))
+
+        return self.schemes[resource]
+
+
+    def prime(self):
+        """
+        Add every open view to the index. Views whose resources are already
+        saved (such as when Sublime was closed in the middle of an earlier
+        bootstrap) are included in the saved views.
+        """
+        self.primed = True
+        for window in sublime.windows():
+            for view in window.views():
+                settings = view.settings()
+                for setting in resource_settings:
+                    for package in self.resource_packages(settings.get(setting)):
+                        self.by_package.setdefault(package, set()).add(view.id())
+
+                if any(settings.has(saved) for saved in saved_settings.values()):
+                    self.saved.add(view.id())
+
+
+    def mark_saved(self, view):
+        """
+        Record that the resources of the given view have been saved, so that
+        the view is included in views_saved().
+        """
+        self.saved.add(view.id())
+
+
+    def live_views(self, view_ids):
+        """
+        Return the views with the given ids that are still open.
+        """
+        views = [sublime.View(view_id) for view_id in view_ids]
+        return [view for view in views if view.is_valid()]
+
+
+    def views_using(self, package):
+        """
+        Return all of the open views that are using a syntax or color scheme
+        from the given package.
+        """
+        if not self.primed:
+            self.prime()
+
+        return self.live_views(self.by_package.get(package, ()))
+
+
+    def views_saved(self):
+        """
+        Return all of the open views whose resources were saved while the
+        bootstrapped package was disabled.
+        """
+        if not self.primed:
+            self.prime()
+
+        return self.live_views(self.saved)
+
+
+### ---------------------------------------------------------------------------
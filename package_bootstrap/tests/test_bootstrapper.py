@@ -0,0 +1,166 @@
+"""
+Tests for the bootstrapper that run outside of Sublime, using a minimal stand
+in for the sublime module; run with:
+
+    python3 -m unittest discover -s package_bootstrap/tests
+"""
+import os
+import sys
+import types
+import tempfile
+import unittest
+
+from unittest import mock
+
+
+### ---------------------------------------------------------------------------
+
+
+class Settings(dict):
+    """
+    A stand in for sublime.Settings.
+    """
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def has(self, key):
+        return key in self
+
+    def erase(self, key):
+        self.pop(key, None)
+
+
+class View():
+    """
+    A stand in for sublime.View; every view is kept in a registry, so that the
+    views can be looked up by id like Sublime does.
+    """
+    views = {}
+
+    def __init__(self, view_id, settings=None):
+        self.view_id = view_id
+        if settings is not None:
+            View.views[view_id] = Settings(settings)
+
+    def id(self):
+        return self.view_id
+
+    def is_valid(self):
+        return self.view_id in View.views
+
+    def settings(self):
+        return View.views[self.view_id]
+
+
+class Window():
+    def views(self):
+        return [View(view_id) for view_id in View.views]
+
+
+def fake_sublime():
+    """
+    Create a module that stands in for the sublime module.
+    """
+    module = types.ModuleType("sublime")
+    module.View = View
+    module.Settings = Settings
+    module.settings = {}
+    module.load_settings = lambda name: module.settings.setdefault(name, Settings())
+    module.windows = lambda: [Window()]
+    module.version = lambda: "4126"
+    module.find_resources = lambda name: []
+    module.installed_packages_path = tempfile.gettempdir
+    module.set_timeout = lambda callback, delay=0: callback()
+    module.set_timeout_async = lambda callback, delay=0: callback()
+    module.error_message = lambda msg: None
+    module.message_dialog = lambda msg: None
+
+    return module
+
+
+sys.modules.setdefault("sublime", fake_sublime())
+sys.modules.setdefault("sublime_plugin", types.ModuleType("sublime_plugin"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from package_bootstrap.core import bootstrapper
+
+
+### ---------------------------------------------------------------------------
+
+
+class BootstrapTests(unittest.TestCase):
+    syntax = "Packages/1_my_package/MyPackage.sublime-syntax"
+    color_scheme = "Packages/1_my_package/MyPackage.sublime-color-scheme"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        View.views.clear()
+
+        sys.modules["sublime"].settings.clear()
+        self.prefs = sys.modules["sublime"].load_settings("Preferences.sublime-settings")
+        self.prefs.set("ignored_packages", ["Vintage"])
+
+        self.view = View(1, {"syntax": self.syntax, "color_scheme": self.color_scheme})
+
+
+    def built_package(self, pkg):
+        """
+        Stand in for building a package; the package is always built, as an
+        empty temporary file.
+        """
+        tmp_file = os.path.join(self.directory.name, pkg + ".sublime-package.tmp")
+        open(tmp_file, "wb").close()
+        return (tmp_file, True)
+
+
+    def test_views_restored_when_install_fails(self):
+        package = os.path.join(self.directory.name, "1_my_package.sublime-package")
+        thread = bootstrapper.BootstrapThread(["1_my_package"])
+
+        with mock.patch.object(thread, "build_package", self.built_package), \
+                mock.patch.object(bootstrapper, "package_path", lambda pkg: package), \
+                mock.patch.object(bootstrapper, "log") as log, \
+                mock.patch.object(bootstrapper.os, "replace",
+                                  side_effect=PermissionError("locked")):
+            thread.bootstrap()
+
+        settings = self.view.settings()
+        self.assertEqual(settings.get("syntax"), self.syntax)
+        self.assertEqual(settings.get("color_scheme"), self.color_scheme)
+        self.assertFalse(any(settings.has(saved)
+                             for saved in bootstrapper.saved_settings.values()))
+
+        self.assertEqual(self.prefs.get("ignored_packages"), ["Vintage"])
+        self.assertEqual(os.listdir(self.directory.name), [])
+        self.assertTrue(log.call_args[1].get("error"))
+
+
+    def test_views_scanned_once(self):
+        other = View(2, {"syntax": "Packages/Python/Python.sublime-syntax"})
+        packages = ["1_my_package", "2_my_package"]
+        thread = bootstrapper.BootstrapThread(packages)
+        sublime = sys.modules["sublime"]
+
+        with mock.patch.object(thread, "build_package", self.built_package), \
+                mock.patch.object(bootstrapper, "package_path",
+                                  lambda pkg: os.path.join(self.directory.name, pkg)), \
+                mock.patch.object(bootstrapper, "log"), \
+                mock.patch.object(sublime, "windows", side_effect=sublime.windows) as windows:
+            thread.bootstrap()
+
+        self.assertEqual(windows.call_count, 1)
+        self.assertEqual(self.view.settings().get("syntax"), self.syntax)
+        self.assertEqual(other.settings(), {"syntax": "Packages/Python/Python.sublime-syntax"})
+        self.assertEqual(sorted(os.listdir(self.directory.name)), packages)
+
+
+### ---------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -25,9 +25,14 @@ if ! pgrep -x sublime_text > /dev/null
 then
     #
     # Sublime is not running, so run a check to clean the session and then
-    # start Sublime with the arguments we were given.
+    # start Sublime with the arguments we were given. Old backups are left
+    # alone; add --backup-keep or --backup-max-age to have them pruned, but
+    # note that those remove any backups you already had, too.
     #
-    sublime_session_clean.py -p text --workspaces --files --folders
+    sublime_session_clean.py -p text --workers 8 --timeout 5 \
+        --cache-file "${XDG_CACHE_HOME:-$HOME/.cache}/sublime_session_clean.json" \
+        --backup-compress gzip --backup-delta \
+        --if-changed --workspaces --files --folders
     sublime_text $*
 else
     #
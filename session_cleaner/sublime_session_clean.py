@@ -17,14 +17,43 @@ is stored as a backup in a file with the current date and time appended.
 This script shouldn't be run while Sublime is actively running, since the
 session information will be written out to disk when Sublime terminates, which
 will cause the changes made by this script to be ignored.
+
+This can also be imported and used as a library; see clean() and CleanOptions.
 """
 
 import argparse
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+import glob
+import gzip
+import hashlib
+import itertools
 import json
 import logging
+import lzma
+import multiprocessing
 import os
+import queue
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Everything is logged here rather than to the root logger, so that using this
+# as a library doesn't change the logging of the program using it; without a
+# handler of its own, warnings would still end up on standard error.
+log = logging.getLogger("sublime_session_clean")
+log.addHandler(logging.NullHandler())
 
 
 _data_dirs = {
@@ -58,35 +87,48 @@ def sublime_data_dir(prog):
 def load_session(file_name, program):
     """
     Load and parse the Sublime session file provided, returning back a tuple
-    containing the overall session file and the recent items. The tuple
-    contains None if there are errors loading or parsing the session file.
+    containing the overall session file, the recent items and the original
+    text of the session. The tuple contains None if there are errors loading
+    or parsing the session file.
     """
     try:
-        with open(file_name, encoding="utf-8") as file:
-            session = json.load(file)
-
-            if program == "text":
-                items = session["workspaces"]["recent_workspaces"]
-                folders = session["folder_history"]
-                files = [w["file_history"] for w in session["windows"] ]
-                files.append(session["settings"]["new_window_settings"]["file_history"])
-            else:
-                items = session["recent"]
-                folders = None
-                files = None
+        # Line endings are left alone so that the text matches the file.
+        with open(file_name, encoding="utf-8", newline="") as file:
+            text = file.read()
+            session = json.loads(text)
 
-            return (session, items, folders, files)
+            return (session, *session_items(session, program), text)
 
     except FileNotFoundError:
-        logging.exception("Unable to locate session file")
+        log.exception("Unable to locate session file")
 
     except ValueError:
-        logging.exception("Session file could not be parsed; invalid JSON?")
+        log.exception("Session file could not be parsed; invalid JSON?")
 
     except KeyError:
-        logging.exception("Session file could not be parsed; invalid format?")
+        log.exception("Session file could not be parsed; invalid format?")
+
+    return (None, None, None, None, None)
+
+
+def session_items(session, program):
+    """
+    Given a parsed Sublime session, return a tuple of the recent items, recent
+    folders and the lists of recent files in it; the items are lists in the
+    session itself, so changing them changes the session. Raises KeyError if
+    the session is not in the expected format.
+    """
+    if program == "text":
+        items = session["workspaces"]["recent_workspaces"]
+        folders = session["folder_history"]
+        files = [w["file_history"] for w in session["windows"] ]
+        files.append(session["settings"]["new_window_settings"]["file_history"])
+    else:
+        items = session["recent"]
+        folders = None
+        files = None
 
-    return (None, None, None, None)
+    return (items, folders, files)
 
 
 def save_session(file_name, session):
@@ -106,14 +148,681 @@ def save_session(file_name, session):
             return file_name
 
     except TypeError:
-        logging.exception("Session file contains non-basic data")
+        log.exception("Session file contains non-basic data")
+
+    except OSError:
+        log.exception("Error saving new session file")
+
+    return None
+
+
+# Values are only skipped over to find where they end, so every object is
+# thrown away as soon as it has been decoded; nothing is kept for longer than
+# the members of one object.
+_skipper = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
+
+
+def skip_value(text, pos):
+    """
+    Return the offset just past the JSON value that starts at the given offset
+    in the text, without building the value; raises ValueError if the text
+    doesn't contain the whole value.
+    """
+    return _skipper.raw_decode(text, pos)[1]
+
+
+def find_spans(text, patterns):
+    """
+    Find the values in the JSON text whose path matches one of the patterns
+    (see path_matches()), returning a dictionary that maps the path of each
+    one to a tuple of its start and end offset within the text.
+
+    Only the containers that lead to matching values are walked; everything
+    else (including the matching values) is skipped over by the JSON decoder,
+    which is much faster, without building the values that it skips.
+    """
+    decoder = json.JSONDecoder()
+    space = re.compile(r"[ \t\r\n]*")
+    spans = {}
+
+    def skip(pos):
+        return skip_value(text, pos)
+
+    def leads_to_match(path):
+        return any(len(pattern) > len(path) and path_matches(pattern[:len(path)], path)
+                   for pattern in patterns)
+
+    def expect(pos, chars):
+        pos = space.match(text, pos).end()
+        if text[pos:pos + 1] not in chars:
+            raise ValueError("Expected one of %s at offset %d" % (chars, pos))
+        return (text[pos], pos + 1)
+
+    def visit(pos, path):
+        pos = space.match(text, pos).end()
+        if any(path_matches(pattern, path) for pattern in patterns):
+            end = skip(pos)
+            spans[path] = (pos, end)
+            return end
+
+        char = text[pos:pos + 1]
+        if char not in ("{", "[") or not leads_to_match(path):
+            return skip(pos)
+
+        closer = "}" if char == "{" else "]"
+        pos = space.match(text, pos + 1).end()
+        if text[pos:pos + 1] == closer:
+            return pos + 1
+
+        index = 0
+        while True:
+            if char == "{":
+                key, pos = decoder.raw_decode(text, space.match(text, pos).end())
+                pos = expect(pos, ":")[1]
+                pos = visit(pos, path + (key,))
+            else:
+                pos = visit(pos, path + (index,))
+                index += 1
+
+            found, pos = expect(pos, "," + closer)
+            if found == closer:
+                return pos
+
+    visit(0, ())
+    return spans
+
+
+def splice_session(file_name, text, session, patterns):
+    """
+    Save the session to a temporary file by taking the original text of the
+    session and replacing only the values matching the patterns that are
+    different in the session than they were in the original text. Everything
+    else is written out exactly as it was.
+
+    The name of the file is returned if the new session is successfully
+    saved, or None on failure.
+    """
+    tmp_file = file_name + ".tmp"
+    try:
+        spans = find_spans(text, patterns)
+        with open(tmp_file, "w", encoding="utf-8", newline="") as file:
+            pos = 0
+            for path, (start, end) in sorted(spans.items(), key=lambda span: span[1]):
+                value = session
+                for key in path:
+                    value = value[key]
+
+                if json.loads(text[start:end]) != value:
+                    file.write(text[pos:start])
+                    file.write(format_json(value, len(path)))
+                    pos = end
+
+            file.write(text[pos:])
+            file.flush()
+            os.fsync(file.fileno())
+
+        return tmp_file
+
+    except (ValueError, KeyError, IndexError):
+        log.exception("Unable to locate changes in session file")
 
     except OSError:
-        logging.exception("Error saving new session file")
+        log.exception("Error saving new session file")
 
     return None
 
 
+def session_lists(program):
+    """
+    Return a list that describes the lists of recent items in the session for
+    the given program. Each entry is a tuple of the path to the list within
+    the session (with None standing in for any array index), the cleanup
+    action that cleans it, the program to check items with and a name for the
+    items in the list.
+    """
+    if program == "text":
+        # Folders are checked as if the program was merge; see clean_session().
+        return [
+            (("workspaces", "recent_workspaces"), "workspaces", "text", "recent workspaces"),
+            (("folder_history",), "folders", "merge", "recent folders"),
+            (("windows", None, "file_history"), "files", "text", "recent files"),
+            (("settings", "new_window_settings", "file_history"), "files", "text", "recent files")
+        ]
+
+    return [(("recent",), "workspaces", "merge", "recent repositories")]
+
+
+def path_matches(pattern, path):
+    """
+    Check if the given path into a JSON document matches the pattern, which
+    is a tuple of keys in which None matches any array index.
+    """
+    return len(pattern) == len(path) and all(
+        key == part or (key is None and isinstance(part, int))
+        for key, part in zip(pattern, path))
+
+
+def format_json(value, depth):
+    """
+    Format the value as JSON in the same style as Sublime uses for its
+    session files, indented to suit a value at the given depth in the
+    document.
+    """
+    text = json.dumps(value, indent="\t", ensure_ascii=False, separators=(',', ': '))
+    return text.replace("\n", "\n" + "\t" * depth)
+
+
+class JsonStreamWalker():
+    """
+    Walk over the JSON document in a binary file one chunk at a time, copying
+    it to an optional output file along the way.
+
+    Values whose path in the document (a tuple of object keys and array
+    indexes) is selected by the capture callable are collected and handed to
+    the replace callable, which can return the bytes to write in place of the
+    value, or None to leave it alone. Other than captured values, nothing more
+    than a single chunk of the document is ever held in memory, so this works
+    for files of any size.
+
+    If a visit callable is provided, it is told the path and the start and end
+    offset in the file of every value that is no deeper than visit_depth.
+
+    If a descend callable is provided, it is asked about each object or array
+    and returns False if nothing inside of it can be captured; such values
+    (when too deep to be visited) are skipped over without being parsed,
+    which is much faster.
+    """
+    chunk_size = 1024 * 1024
+
+    _space = re.compile(rb"[ \t\r\n]*")
+    _scalar = re.compile(rb"[^ \t\r\n,\]}]*")
+
+    # The body of a string up to the closing quote (or the end of the chunk).
+    _string_body = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+    def __init__(self, infile, outfile=None, capture=None, replace=None,
+                 visit=None, visit_depth=0, descend=None):
+        self.infile = infile
+        self.outfile = outfile
+        self.capture = capture or (lambda path: False)
+        self.replace = replace or (lambda path, raw: None)
+        self.visit = visit
+        self.visit_depth = visit_depth
+        self.descend = descend or (lambda path: True)
+
+        # The current chunk, the position within it, the position up to which
+        # it has been copied to the output, and its offset within the file.
+        self.buffer = b""
+        self.pos = 0
+        self.mark = 0
+        self.offset = 0
+
+        # The current chunk decoded as latin-1 (so that offsets within it are
+        # the same as in the bytes) for skipping values with skip_value(); it
+        # is only decoded once something in the chunk needs to be skipped.
+        self.text = None
+
+        # When capturing a value, this collects the bytes that would otherwise
+        # be written to the output.
+        self.captured = None
+
+    def write(self, data):
+        if self.captured is not None:
+            self.captured += data
+        elif self.outfile is not None:
+            self.outfile.write(data)
+
+    def flush(self):
+        self.write(self.buffer[self.mark:self.pos])
+        self.mark = self.pos
+
+    def fill(self):
+        """
+        Move on to the next chunk of the file once the current one has been
+        consumed, returning False if there is no more data.
+        """
+        self.pos = len(self.buffer)
+        self.flush()
+
+        self.offset += len(self.buffer)
+        self.buffer = self.infile.read(self.chunk_size)
+        self.pos = self.mark = 0
+        self.text = None
+
+        return len(self.buffer) > 0
+
+    def peek(self):
+        """
+        Skip any white space and return the next character in the document,
+        or None if the end has been reached.
+        """
+        while True:
+            self.pos = self._space.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos:self.pos + 1]
+
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of %s at offset %d" % (
+                chars.decode(), self.offset + self.pos))
+
+        self.pos += 1
+        return char
+
+    def string(self, keep=False):
+        """
+        Skip over the string at the current position, returning its decoded
+        value if keep is True.
+        """
+        self.expect(b'"')
+        parts = []
+        start = self.pos
+
+        while True:
+            self.pos = self._string_body.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) and self.buffer[self.pos] == 0x22:
+                self.pos += 1
+                if not keep:
+                    return None
+
+                parts.append(self.buffer[start:self.pos])
+                return json.loads(b'"' + b"".join(parts))
+
+            # The string continues into the next chunk; if this chunk ends in
+            # the middle of an escape sequence, the escaped character is the
+            # first one in the next chunk.
+            escape = self.pos < len(self.buffer)
+            if keep:
+                parts.append(self.buffer[start:])
+
+            if not self.fill():
+                raise ValueError("Unterminated string in JSON")
+
+            self.pos = 1 if escape else 0
+            start = 0
+
+    def scalar(self):
+        """
+        Skip over the number, boolean or null at the current position.
+        """
+        while True:
+            self.pos = self._scalar.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return
+
+    def skip(self):
+        """
+        Skip over the object or array at the current position without parsing
+        it. When it ends within the current chunk the JSON decoder skips over
+        it in one go; otherwise its members are skipped one at a time, so only
+        the one that runs into the next chunk is looked into any further.
+        """
+        if self.text is None:
+            self.text = self.buffer.decode("latin-1")
+
+        try:
+            self.pos = skip_value(self.text, self.pos)
+            return
+        except ValueError:
+            pass
+
+        closer = b"}" if self.expect(b"{[") == b"{" else b"]"
+        if self.peek() == closer:
+            self.pos += 1
+            return
+
+        while True:
+            if closer == b"}":
+                self.string()
+                self.expect(b":")
+
+            char = self.peek()
+            if char is None:
+                raise ValueError("Unexpected end of JSON")
+            elif char in b"{[":
+                self.skip()
+            elif char == b'"':
+                self.string()
+            else:
+                self.scalar()
+
+            if self.expect(b"," + closer) == closer:
+                return
+
+    def object(self, path):
+        self.expect(b"{")
+        if self.peek() == b"}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.string(keep=True)
+            self.expect(b":")
+            self.value(path + (key,))
+            if self.expect(b",}") == b"}":
+                return
+
+    def array(self, path):
+        self.expect(b"[")
+        if self.peek() == b"]":
+            self.pos += 1
+            return
+
+        index = 0
+        while True:
+            self.value(path + (index,))
+            if self.expect(b",]") == b"]":
+                return
+            index += 1
+
+    def value(self, path):
+        char = self.peek()
+        if char is None:
+            raise ValueError("Unexpected end of JSON")
+
+        start = self.offset + self.pos
+        capturing = self.capture(path)
+        if capturing:
+            self.flush()
+            outer, self.captured = self.captured, bytearray()
+
+        if char in b"{[" and len(path) >= self.visit_depth and not self.descend(path):
+            self.skip()
+        elif char == b"{":
+            self.object(path)
+        elif char == b"[":
+            self.array(path)
+        elif char == b'"':
+            self.string()
+        else:
+            self.scalar()
+
+        if capturing:
+            self.flush()
+            raw, self.captured = bytes(self.captured), outer
+
+            replacement = self.replace(path, raw)
+            self.write(raw if replacement is None else replacement)
+
+        if self.visit is not None and len(path) <= self.visit_depth:
+            self.visit(path, start, self.offset + self.pos)
+
+    def walk(self):
+        """
+        Walk the whole document, copying it to the output file.
+        """
+        self.value(())
+        if self.peek() is not None:
+            raise ValueError("Extra data at offset %d" % (self.offset + self.pos))
+
+
+def path_name(path):
+    """
+    Return a readable name for a path into a JSON document, such as
+    windows[0].buffers[2].contents; None in a pattern is shown as *.
+    """
+    name = ""
+    for key in path:
+        if key is None or isinstance(key, int):
+            name += "[%s]" % ("*" if key is None else key)
+        else:
+            name += ("." if name else "") + key
+
+    return name or "(session)"
+
+
+def human_size(size):
+    """
+    Format a size in bytes for display.
+    """
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024.0
+
+    return ("%d %s" if unit == "bytes" else "%.1f %s") % (size, unit)
+
+
+class SessionAnalysis():
+    """
+    Gather information on where the space in a session file is going while it
+    is walked by a JsonStreamWalker, for use by analyze_session().
+
+    Sizes are collected for every value down to a limited depth, both for the
+    value itself and for the pattern of its path (with array indexes replaced
+    by wildcards) so that, for example, the undo stacks of all buffers in all
+    windows are totalled together.
+    """
+    max_depth = 5
+
+    # The minimum fraction of the total size that a location needs to take up
+    # in order to be listed in the report.
+    threshold = 0.01
+
+    def __init__(self, program):
+        self.total = 0
+        self.patterns = {}
+        self.windows = {}
+        self.buffers = {}
+        self.histories = {}
+        self.files = {}
+        self.lists = session_lists(program)
+        self.recent = []
+
+    def visit(self, path, start, end):
+        size = end - start
+        if not path:
+            self.total = size
+            return
+
+        pattern = tuple(None if isinstance(key, int) else key for key in path)
+        entry = self.patterns.setdefault(pattern, [0, 0])
+        entry[0] += size
+        entry[1] += 1
+
+        if len(path) == 2 and path[0] == "windows":
+            self.windows[path[1]] = size
+        elif len(path) == 4 and pattern == ("windows", None, "buffers", None):
+            self.buffers[path[1], path[3]] = size
+
+    def descend(self, path):
+        # Everything of interest is no deeper than the deepest visited values
+        return False
+
+    def capture(self, path):
+        if any(path_matches(entry[0], path) for entry in self.lists):
+            return True
+
+        if len(path) == 5 and path_matches(("windows", None, "buffers", None, "file"), path):
+            return True
+
+        last = path[-1] if path else None
+        return isinstance(last, str) and last.endswith("history")
+
+    def replace(self, path, raw):
+        value = json.loads(raw.decode("utf-8"))
+        if path[-1] == "file":
+            self.files[path[1], path[3]] = value
+            return None
+
+        if isinstance(value, list):
+            self.histories[path] = len(value)
+
+        for entry in self.lists:
+            if path_matches(entry[0], path) and isinstance(value, list):
+                self.recent.append((path, entry, value))
+
+        return None
+
+    def estimate_clean(self, cache):
+        """
+        Check the items in all of the recent lists and return the number of
+        items that a clean would remove and the approximate number of bytes
+        that would save.
+        """
+        cache.prefetch(item_location(item, entry[2])[0]
+                       for path, entry, items in self.recent for item in items)
+
+        count = saved = 0
+        for path, (pattern, action, program, item_name), items in self.recent:
+            for item in items:
+                if cache.item_exists(item, program) is False:
+                    count += 1
+                    # The item, its separator and the indent on its line
+                    saved += len(format_json(item, 0).encode("utf-8")) + len(path) + 3
+
+        return (count, saved)
+
+    def report(self, cache):
+        """
+        Log a report of the gathered information.
+        """
+        total = max(self.total, 1)
+        minimum = total * self.threshold
+
+        def line(size, name, extra=""):
+            log.info("  %10s %5.1f%%  %s%s", human_size(size),
+                     size * 100.0 / total, name, extra)
+
+        log.info("Session size: %s\n", human_size(self.total))
+
+        log.info("Size by location in the session:")
+        for pattern, (size, count) in sorted(self.patterns.items(),
+                                             key=lambda entry: path_name(entry[0])):
+            if size >= minimum:
+                line(size, path_name(pattern),
+                     "  (%d values)" % count if None in pattern else "")
+        log.info("")
+
+        if self.windows:
+            log.info("Size by window:")
+            for window, size in sorted(self.windows.items()):
+                line(size, "windows[%d]" % window)
+            log.info("")
+
+        buffers = [entry for entry in self.buffers.items() if entry[1] >= minimum]
+        if buffers:
+            log.info("Largest buffers:")
+            for (window, buf), size in sorted(buffers, key=lambda entry: -entry[1]):
+                line(size, "windows[%d].buffers[%d]" % (window, buf),
+                     "  %s" % self.files.get((window, buf), "(untitled)"))
+            log.info("")
+
+        if self.histories:
+            log.info("History lengths:")
+            for path, length in sorted(self.histories.items(), key=lambda entry: path_name(entry[0])):
+                log.info("  %6d  %s", length, path_name(path))
+            log.info("")
+
+        count, saved = self.estimate_clean(cache)
+        log.info("Cleaning all recent items would remove %d item(s), saving about %s",
+                 count, human_size(saved))
+
+
+def analyze_session(args):
+    """
+    Walk over the session file from the data directory for the specified
+    program without loading it into memory, and report on what is taking up
+    space inside of it and roughly how much a clean would save.
+    """
+    session_file = os.path.join(args.data_dir, "Local", "Session.sublime_session")
+    log.info("Using Data Directory: %s", args.data_dir)
+
+    analysis = SessionAnalysis(args.program)
+    try:
+        with open(session_file, "rb") as file:
+            JsonStreamWalker(file, None, analysis.capture, analysis.replace,
+                             analysis.visit, analysis.max_depth,
+                             analysis.descend).walk()
+
+    except FileNotFoundError:
+        return log.exception("Unable to locate session file")
+
+    except ValueError:
+        return log.exception("Session file could not be parsed; invalid JSON?")
+
+    analysis.report(make_cache(args))
+
+
+def session_fingerprint(file_name, actions, digest=True):
+    """
+    Return a dictionary that fingerprints the given session file, which is
+    used to tell if the session has changed since the last time that it was
+    cleaned. The fingerprint includes the cleanup actions used, since a clean
+    with different actions could still have work to do. The content hash is
+    only calculated when digest is True. Returns None on error.
+    """
+    try:
+        info = os.stat(file_name)
+        fingerprint = {
+            "size": info.st_size,
+            "mtime": info.st_mtime_ns,
+            "actions": actions
+        }
+
+        if digest:
+            sha = hashlib.sha256()
+            with open(file_name, "rb") as file:
+                for chunk in iter(partial(file.read, 1024 * 1024), b""):
+                    sha.update(chunk)
+            fingerprint["sha256"] = sha.hexdigest()
+
+        return fingerprint
+
+    except OSError:
+        return None
+
+
+def session_unchanged(file_name, fingerprint_file, actions):
+    """
+    Check the fingerprint of the session file against the one stored in the
+    fingerprint file by the last clean, returning True if they match. The
+    size and modification time are checked first, and the content hash is
+    only calculated if the session looks to have been written without having
+    been changed in size.
+    """
+    try:
+        with open(fingerprint_file, encoding="utf-8") as file:
+            last = json.load(file)
+
+    except (OSError, ValueError):
+        return False
+
+    current = session_fingerprint(file_name, actions, digest=False)
+    if current is None or not isinstance(last, dict):
+        return False
+
+    if any(current[key] != last.get(key) for key in ("size", "actions")):
+        return False
+
+    if current["mtime"] == last.get("mtime"):
+        return True
+
+    current = session_fingerprint(file_name, actions)
+    return current is not None and current["sha256"] == last.get("sha256")
+
+
+def save_fingerprint(file_name, fingerprint_file, actions):
+    """
+    Store the fingerprint of the session file in the fingerprint file so that
+    a future clean can tell if it needs to do anything.
+    """
+    fingerprint = session_fingerprint(file_name, actions)
+    if fingerprint is None:
+        return
+
+    try:
+        with open(fingerprint_file, "w", encoding="utf-8") as file:
+            json.dump(fingerprint, file, indent="\t", sort_keys=True)
+
+    except OSError:
+        log.exception("Error saving session fingerprint")
+
+
 def item_path(item, program):
     """
     More recent versions of Sublime Merge use a recent list that contains state
@@ -126,11 +835,11 @@ def item_path(item, program):
     return item
 
 
-def item_exists(item, program):
+def item_location(item, program):
     """
     Given a path that represents a workspace or repository item (based on
-    program), return a determination as to whether that item is still valid or
-    not.
+    program), return a tuple of the path on disk that the item represents and
+    whether that path is expected to be a directory (True) or a file (False).
 
     Some code invokes this with a program of "merge" when it knows that it
     wants to check for folders and not files, as a mild hack.
@@ -145,132 +854,2031 @@ def item_exists(item, program):
             drive=path[1],
             path=path[2:])
 
-    return os.path.isdir(path) if program == "merge" else os.path.isfile(path)
+    return (path, program == "merge")
 
 
-def clean_items(checked_items, program, item_name):
+def item_exists(item, program):
     """
-    Given a list of items to check (workspace files, folders, git repositories,
-    files, etc), modify the list such that any items that no longer exist are
-    removed from the list on return. The list is modified in place.
+    Given a path that represents a workspace or repository item (based on
+    program), return a determination as to whether that item is still valid or
+    not.
+    """
+    path, is_dir = item_location(item, program)
+    return os.path.isdir(path) if is_dir else os.path.isfile(path)
 
-    The check done is based on the program doing the check and the item itself.
+
+class MountScheduler():
     """
-    if checked_items is None:
-        print("No items; doing nothing")
-        return False
+    Decide how the checks for paths on each mounted file system are scheduled.
 
-    present, missing = [], []
-    for item in checked_items:
-        status_list = present if item_exists(item, program) else missing
-        status_list.append(item)
+    Every path is mapped to the mount that it lives on (using the mount table
+    in /proc/self/mountinfo on Linux, or the drive or UNC share on Windows).
+    Checks on local file systems are only limited by the number of workers,
+    but checks on network file systems are limited to remote_workers at once
+    per mount, and when a budget is given, to that many seconds of checking per
+    mount in total.
 
-    if len(present) != len(checked_items):
-        logging.info("Cleaning up %s:" % item_name)
-        for item in missing:
-            logging.info("  %s", item_path(item, program))
-        logging.info("Cleaned %d item(s)\n", len(missing))
+    A mount that has had a check time out is assumed to be offline for the
+    rest of the run, and a mount whose budget is used up is deferred; either
+    way, everything else on that mount is skipped (and so kept) without being
+    checked, so that a single dead share can't hold up the whole clean.
+    """
+    remote_types = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "9p", "afs",
+                    "ceph", "davfs", "glusterfs", "lustre", "sshfs")
 
-        checked_items[:] = present
-        return True
+    def __init__(self, remote_workers=2, budget=None, mountinfo="/proc/self/mountinfo"):
+        self.remote_workers = max(remote_workers, 1)
+        self.budget = budget
+        self.mounts = self.load(mountinfo)
+        self.remote = {}
+        self.spent = {}
+        self.offline = set()
+        self.lock = threading.Lock()
 
-    return False
+    @staticmethod
+    def load(mountinfo):
+        """
+        Load the mount table from the given mountinfo file, returning a list
+        of tuples of mount point and file system type, with the longest (and
+        so most specific) mount points first. The list is empty if there is no
+        mount table to load.
+        """
+        def unescape(field):
+            return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
 
+        mounts = []
+        try:
+            with open(mountinfo, encoding="utf-8", errors="surrogateescape") as file:
+                for line in file:
+                    fields = line.split()
+                    if "-" not in fields[6:]:
+                        continue
 
-def clean_session(args):
-    """
-    Load the session file from the data directory for the specified program and
-    perform the requested clean up operations to remove items that are marked
-    as recent but which no longer exist on disk, writing the session back.
+                    fs_type = fields[fields.index("-", 6) + 1]
+                    mounts.append((unescape(fields[4]), fs_type))
 
-    This attempts to keep a backup of the existing session file and creates a
-    temporary session first in case things go pear shaped.
-    """
-    session_file = os.path.join(args.data_dir, "Local", "Session.sublime_session")
-    tmp_file = session_file + ".tmp"
-    bkp_file = session_file + datetime.now().strftime(".%Y%m%d_%H%M%S")
+        except (OSError, IndexError):
+            pass
 
-    logging.info("Using Data Directory: %s", args.data_dir)
-    if args.dry_run:
-        logging.info("--- PERFORMING DRY RUN: No Actions will be taken! ---")
+        return sorted(mounts, key=lambda mount: len(mount[0]), reverse=True)
 
-    session, check_items, check_folders, check_files = load_session(session_file, args.program)
-    if session is not None:
-        check1 = check2 = check3 = False
+    def is_remote_type(self, fs_type):
+        """
+        Return True if the given file system type is one that is accessed over
+        the network, which includes everything mounted via FUSE.
+        """
+        return fs_type.split(".")[-1] in self.remote_types or fs_type.startswith("fuse.")
 
-        if args.workspaces:
-            item_type = "recent %s" % ("workspaces" if args.program == "text" else "repositories")
-            check1 = clean_items(check_items, args.program, item_type)
+    def mount_for(self, path):
+        """
+        Return the mount point that the given path lives on. The path is not
+        resolved, since that could block on the very mount we are trying to
+        avoid.
+        """
+        path = os.path.abspath(path or os.curdir)
+        drive = os.path.splitdrive(path)[0]
+        if drive:
+            with self.lock:
+                self.remote.setdefault(drive, drive[:2] in ("\\\\", "//"))
+            return drive
 
-        if args.folders and check_folders:
-            # Force the program to be merge because merge handles folders for us
-            # transparently, and it doesn't support the notion of recent folders
-            # anyway.
-            check2 = clean_items(check_folders, "merge", "recent folders")
+        for mount_point, fs_type in self.mounts:
+            if path == mount_point or path.startswith(mount_point.rstrip("/") + "/"):
+                with self.lock:
+                    self.remote.setdefault(mount_point, self.is_remote_type(fs_type))
+                return mount_point
 
-        if args.files and check_files:
-            for file_list in check_files:
-                check3 = clean_items(file_list, args.program, "recent files") or check3
+        return ""
 
-        if any((check1, check2, check3)):
-            if args.dry_run:
-                logging.info("--- PERFORMING DRY RUN: Session WILL NOT be modified ---")
-                return
+    def limit(self, mount):
+        """
+        Return the number of checks that may run on the given mount at once,
+        or None if there is no limit.
+        """
+        return self.remote_workers if self.remote.get(mount) else None
 
-            tmp_file = save_session(session_file, session)
-            if tmp_file is not None:
-                try:
-                    os.rename(session_file, bkp_file)
-                    os.rename(tmp_file, session_file)
+    def usable(self, mount):
+        """
+        Return True if checks on the given mount should still be run.
+        """
+        with self.lock:
+            return mount not in self.offline and (
+                self.budget is None or not self.remote.get(mount) or
+                self.spent.get(mount, 0) < self.budget)
 
-                    logging.info("New session file saved")
-                    logging.info("Previous session backed up to: DATA_DIR%s%s" % (
-                        os.path.sep,
-                        os.path.relpath(bkp_file, args.data_dir)))
+    def record(self, mount, elapsed):
+        """
+        Record that a check on the given mount took the given number of
+        seconds, and return False if the mount can't be used any more, either
+        because its budget is now used up or because it has gone offline
+        while the check was running.
+        """
+        with self.lock:
+            if mount in self.offline:
+                return False
 
-                except OSError:
-                    logging.exception("Error replacing session file")
+            spent = self.spent.get(mount, 0)
+            self.spent[mount] = spent + elapsed
 
-        else:
-            logging.info("Nothing found to clean up")
+            over_budget = (self.budget is not None and self.remote.get(mount) and
+                           spent + elapsed >= self.budget)
+            if not over_budget:
+                return True
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
+        # Only the check that uses up the budget reports it.
+        if spent < self.budget:
+            log.warning("Checks on %s took longer than %gs; deferring the rest",
+                        mount, self.budget)
+        return False
 
+    def timed_out(self, mount):
+        """
+        Record that a check on the given mount timed out, after which the mount
+        is assumed to be offline.
+        """
+        with self.lock:
+            if mount in self.offline:
+                return
+            self.offline.add(mount)
 
-    parser = argparse.ArgumentParser(description="Clean Sublime Text/Merge session files",
-                                     epilog="At least one cleanup action must be selected",
-                                     prefix_chars="-+")
-    parser.add_argument("--program", "-p",
-                        help="Specify the program to clean [Default: text]",
-                        choices=["text", "merge"],
-                        default="text")
-    parser.add_argument("--data-dir", "-d",
-                        help="Specify the Sublime Data directory to use")
+        log.warning("%s appears to be offline; skipping the rest of it", mount or "/")
 
-    parser.add_argument("--dry-run",
-                        help="Run clean but don't write the new session file",
-                        action="store_true")
 
-    actions = parser.add_argument_group("Available Cleanup Actions")
+def run_checks(checks, workers=1, timeout=None, scheduler=None):
+    """
+    Given a dictionary whose values are callables, run all of the callables and
+    return a dictionary with the same keys that holds the result of each one.
 
-    actions.add_argument("--workspaces", "-w",
-                        help="Clean up recently used workspaces, projects and repositories",
-                        action="store_true")
+    When more than one worker is requested or a timeout is given, the checks
+    are run in a bounded pool of worker threads. Any check that is still
+    running timeout seconds after it started is abandoned and given a result
+    of None. A stat on a stale network mount can block forever, so workers are
+    daemon threads (so they can't stop the script from exiting) and a worker
+    that gets abandoned is replaced so that the rest of the checks can
+    continue.
 
-    actions.add_argument("--files", "-f",
-                        help="Clean up recently used files",
-                        action="store_true")
+    When given a MountScheduler, the keys are taken to be paths, and checks
+    are limited per mount as it directs; checks on mounts that it considers
+    offline or out of budget are not run, and are given a result of None.
+    """
+    if scheduler is None and workers <= 1 and timeout is None:
+        return {key: check() for key, check in checks.items()}
 
-    actions.add_argument("--folders", "-o",
-                        help="Clean up recently used folders [Default: False]",
+    mounts = {key: scheduler.mount_for(key) if scheduler else None for key in checks}
+    pending = {}
+    for key in checks:
+        pending.setdefault(mounts[key], []).append(key)
+
+    finished = queue.Queue()
+    running = {}
+    busy = {}
+    ready = threading.Condition()
+
+    def skip(mount):
+        # Give everything still pending on the mount a result of None; this is
+        # called with the condition held.
+        for key in pending.pop(mount, []):
+            finished.put((key, None))
+        ready.notify_all()
+
+    def next_key():
+        # Return the next key that is allowed to run, None if the checks that
+        # are left have to wait for a running one, or False if nothing is left.
+        for mount, keys in list(pending.items()):
+            if scheduler is not None and not scheduler.usable(mount):
+                skip(mount)
+                continue
+
+            limit = scheduler.limit(mount) if scheduler else None
+            if limit is None or busy.get(mount, 0) < limit:
+                busy[mount] = busy.get(mount, 0) + 1
+                key = keys.pop(0)
+                if not keys:
+                    del pending[mount]
+                return key
+
+        return None if pending else False
+
+    def worker():
+        while True:
+            with ready:
+                key = next_key()
+                while key is None:
+                    ready.wait()
+                    key = next_key()
+
+                if key is False:
+                    return
+
+                running[key] = time.monotonic()
+
+            try:
+                result = checks[key]()
+            except Exception as error:
+                result = error
+
+            with ready:
+                # If we're no longer running, we were abandoned because we
+                # took too long and someone else has taken our place.
+                started = running.pop(key, None)
+                if started is None:
+                    return
+
+                mount = mounts[key]
+                busy[mount] -= 1
+                if scheduler is not None and not scheduler.record(mount, time.monotonic() - started):
+                    skip(mount)
+                ready.notify_all()
+
+            finished.put((key, result))
+
+    def spawn_worker():
+        threading.Thread(target=worker, daemon=True).start()
+
+    for _ in range(min(max(workers, 1), len(checks))):
+        spawn_worker()
+
+    poll = None if timeout is None else min(timeout / 4, 0.1)
+    results = {}
+    while len(results) < len(checks):
+        try:
+            key, result = finished.get(timeout=poll)
+            if isinstance(result, Exception):
+                raise result
+            results[key] = result
+        except queue.Empty:
+            pass
+
+        if timeout is None:
+            continue
+
+        now = time.monotonic()
+        with ready:
+            expired = [key for key, started in running.items()
+                       if now - started >= timeout]
+            for key in expired:
+                del running[key]
+                if scheduler is not None:
+                    scheduler.timed_out(mounts[key])
+                    skip(mounts[key])
+
+        for key in expired:
+            log.warning("Timed out while checking %s", key)
+            results[key] = None
+            spawn_worker()
+
+    return results
+
+
+class Stats():
+    """
+    Collect the time taken by each phase of a clean and counters for the work
+    done (such as the number of stat calls), to find out where the time goes
+    when cleaning is slow. Counters can be updated from several threads.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.io_start = self.io_counters()
+        self.phases = []
+        self.counters = {"stat_calls": 0, "dir_listings": 0, "cache_hits": 0,
+                         "persisted_hits": 0, "shared_hits": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def io_counters():
+        """
+        Return a tuple of the number of bytes read and written by this process
+        so far, or None if that's not available on this platform.
+        """
+        try:
+            with open("/proc/self/io") as file:
+                fields = dict(line.split(":", 1) for line in file if ":" in line)
+            return (int(fields["rchar"]), int(fields["wchar"]))
+
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def peak_rss():
+        """
+        Return the peak resident set size of this process in bytes, or None if
+        that's not available on this platform.
+        """
+        if resource is None:
+            return None
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def count(self, counter, amount=1):
+        """
+        Add the given amount to the given counter.
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the code run in the body of a with statement as the named phase.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append({"phase": name,
+                                    "seconds": round(time.monotonic() - started, 6)})
+
+    def as_dict(self):
+        """
+        Return the statistics collected so far as a dictionary that can be
+        serialized as JSON.
+        """
+        io_now = self.io_counters()
+        with self.lock:
+            result = {
+                "wall_time": round(time.monotonic() - self.started, 6),
+                "phases": list(self.phases),
+                "counters": dict(self.counters),
+                "peak_rss": self.peak_rss(),
+                "bytes_read": None,
+                "bytes_written": None
+            }
+
+        if io_now is not None and self.io_start is not None:
+            result["bytes_read"] = io_now[0] - self.io_start[0]
+            result["bytes_written"] = io_now[1] - self.io_start[1]
+
+        return result
+
+
+# Sentinel values stored in the ExistenceCache for a directory that could not
+# be listed; either it does not exist, or it exists but can't be listed, in
+# which case the items inside of it need to be checked one at a time.
+_MISSING = "missing"
+_UNLISTABLE = "unlistable"
+
+
+class PartialListing(dict):
+    """
+    A directory listing that was reconstructed from the persistent cache, and
+    so only knows about the entries that were asked about in a previous run.
+    """
+    pass
+
+
+class ExistenceCache():
+    """
+    Answer the question of whether paths exist or not for the duration of a
+    single clean run.
+
+    The same directories tend to appear over and over in the various recent
+    lists, so rather than checking every path individually, paths are grouped
+    by the directory that contains them and each directory is listed only once
+    (using run_checks(), so that listings happen in parallel and can time out).
+    The listing answers the question for every item in the directory, and if
+    the directory no longer exists, neither does anything inside of it.
+
+    When given a cache file, the results are also persisted between runs,
+    along with the modification time of the directory that contains each
+    path; a directory whose modification time has not changed since the last
+    run can't have had anything added or removed, so only a stat of the
+    directory is needed instead of a listing.
+
+    When given a shared mapping (such as a multiprocessing Manager dict),
+    directory listings are also shared with other caches using the same
+    mapping, which allows cleans running in several processes at once to
+    avoid listing the same directories.
+
+    When given a MountScheduler, directory listings are scheduled per mount
+    as it directs (see run_checks()). The work done is counted in the Stats
+    object given (or a new one).
+    """
+    # Directories modified this recently (in nanoseconds) could change again
+    # without their modification time changing, so they are never persisted.
+    settle_time = 2 * 10**9
+
+    def __init__(self, workers=1, timeout=None, cache_file=None, shared=None, scheduler=None,
+                 stats=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.shared = shared
+        self.scheduler = scheduler
+        self.stats = stats or Stats()
+        self.dirs = {}
+
+        # On platforms where the file system is usually case insensitive, a
+        # name that isn't in a listing is looked up again without case.
+        self.fold_case = sys.platform.startswith(("win", "darwin"))
+
+        # The results persisted from the last run, and those from this run that
+        # will be persisted for the next one. Both map a path to a list that
+        # contains the result and the modification time of its directory.
+        self.known = self.load() if cache_file else {}
+        self.learned = {}
+        self.mtimes = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the persisted results from the cache file, if there is one.
+        """
+        try:
+            with open(self.cache_file, encoding="utf-8") as file:
+                return json.load(file)["paths"]
+
+        except FileNotFoundError:
+            pass
+
+        except (OSError, ValueError, KeyError, TypeError):
+            log.warning("Ignoring unusable cache file %s", self.cache_file)
+
+        return {}
+
+    def save(self):
+        """
+        Persist the results of this run to the cache file, if there is one.
+        Only paths that were checked during this run are saved, so items that
+        are no longer in the session eventually fall out of the cache.
+        """
+        if not self.cache_file:
+            return
+
+        tmp_file = self.cache_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as file:
+                json.dump({"version": 1, "paths": self.learned}, file,
+                          ensure_ascii=False,
+                          separators=(',', ':'))
+
+            os.replace(tmp_file, self.cache_file)
+
+        except OSError:
+            log.exception("Error saving cache file")
+
+    @staticmethod
+    def split_path(path):
+        """
+        Split a path into the directory that contains it and its name within
+        that directory, ignoring any trailing path separators.
+        """
+        stripped = path.rstrip("/\\")
+        return os.path.split(stripped or path)
+
+    def list_dir(self, path):
+        """
+        List the directory with the given path, returning a dictionary that
+        maps the name of each entry to True for directories and False for
+        files, or one of the sentinel values if the directory can't be listed.
+
+        Errors other than the directory being missing or not readable mean that
+        we can't tell (for example a dead FUSE mount) and produce None, which
+        is also what a timeout produces.
+        """
+        listing = {}
+        self.stats.count("dir_listings")
+        try:
+            with os.scandir(path or os.curdir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        listing[entry.name] = True
+                    elif entry.is_file():
+                        listing[entry.name] = False
+
+        except (FileNotFoundError, NotADirectoryError):
+            return _MISSING
+
+        except PermissionError:
+            return _UNLISTABLE
+
+        except OSError as error:
+            log.warning("Unable to list %s: %s", path, error)
+            return None
+
+        return listing
+
+    def check_dir(self, path, names):
+        """
+        Obtain the listing for the directory with the given path, which is
+        expected to contain the given names. If the persisted results know
+        about all of the names and the directory has not been modified since,
+        a listing is reconstructed from them instead of listing the directory.
+        """
+        if not self.cache_file:
+            return self.list_dir(path)
+
+        self.stats.count("stat_calls")
+        try:
+            mtime = os.stat(path or os.curdir).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return _MISSING
+        except OSError:
+            return self.list_dir(path)
+
+        paths = {name: os.path.join(path, name) for name in names}
+        known = [self.known.get(full_path) for full_path in paths.values()]
+        if all(entry is not None and entry[1] == mtime for entry in known):
+            listing = PartialListing((name, entry[0])
+                        for name, entry in zip(paths, known))
+            self.stats.count("persisted_hits")
+        else:
+            listing = self.list_dir(path)
+            if not isinstance(listing, dict):
+                return listing
+
+        if time.time_ns() - mtime >= self.settle_time:
+            with self.lock:
+                self.mtimes[path] = mtime
+
+        return listing
+
+    def prefetch(self, paths):
+        """
+        Given an iterable of paths, list all of the directories that contain
+        them that have not already been listed.
+        """
+        parents = {}
+        for path in paths:
+            parent, name = self.split_path(path)
+            parents.setdefault(parent, set()).add(name)
+
+        wanted = [parent for parent in parents if parent not in self.dirs]
+        if self.shared is not None:
+            for parent in wanted:
+                listing = self.shared.get(parent, False)
+                if listing is not False:
+                    self.dirs[parent] = listing
+                    self.stats.count("shared_hits")
+
+        checks = {parent: partial(self.check_dir, parent, parents[parent])
+                  for parent in wanted if parent not in self.dirs}
+        results = run_checks(checks, self.workers, self.timeout, self.scheduler)
+        self.dirs.update(results)
+
+        # Listings rebuilt from the persisted results are incomplete, so they
+        # are not shared.
+        if self.shared is not None:
+            self.shared.update({parent: listing for parent, listing in results.items()
+                                if not isinstance(listing, PartialListing)})
+
+    def exists(self, path, is_dir):
+        """
+        Return True if the path exists and is a directory (or a file if is_dir
+        is False), False if it does not, or None if it's not possible to tell.
+        """
+        parent, name = self.split_path(path)
+        if parent not in self.dirs:
+            self.prefetch([path])
+
+        listing = self.dirs[parent]
+        if listing is None:
+            return None
+
+        # Listings from a shared mapping are copies, so the sentinel values
+        # can't be compared by identity.
+        if listing == _MISSING:
+            return False
+
+        if listing == _UNLISTABLE or not name:
+            # Checking the path itself can block on a dead mount just like a
+            # listing can, so it's scheduled and timed out in the same way.
+            self.stats.count("stat_calls")
+            check = partial(os.path.isdir if is_dir else os.path.isfile, path)
+            return run_checks({path: check}, self.workers, self.timeout, self.scheduler)[path]
+
+        if name not in listing and isinstance(listing, PartialListing):
+            # Persisted results only know about the names asked about in the
+            # past, so anything else requires a real listing.
+            del self.dirs[parent]
+            self.dirs.update(run_checks({parent: partial(self.list_dir, parent)},
+                                        self.workers, self.timeout, self.scheduler))
+            return self.exists(path, is_dir)
+
+        self.stats.count("cache_hits")
+        kind = listing.get(name)
+        if name not in listing and self.fold_case:
+            folded = name.casefold()
+            kind = next((entry_kind for entry, entry_kind in listing.items()
+                         if entry.casefold() == folded), None)
+
+        if parent in self.mtimes:
+            self.learned[os.path.join(parent, name)] = [kind, self.mtimes[parent]]
+
+        return kind is is_dir
+
+    def item_exists(self, item, program):
+        """
+        The equivalent of item_exists(), but using the cache; as above this
+        can return None when the existence of the item can't be determined.
+        """
+        return self.exists(*item_location(item, program))
+
+
+def make_cache(args, shared=None, stats=None):
+    """
+    Create an ExistenceCache configured by the given command line arguments,
+    counting its work in the given Stats object (if any). Checks are only
+    scheduled per mount when they can run in parallel or time out, or when a
+    mount budget is given.
+    """
+    scheduler = None
+    if args.workers > 1 or args.timeout is not None or args.mount_budget is not None:
+        scheduler = MountScheduler(args.remote_workers, args.mount_budget)
+
+    return ExistenceCache(args.workers, args.timeout, args.cache_file, shared, scheduler,
+                          stats)
+
+
+def clean_items(checked_items, program, item_name, cache=None, removed=None):
+    """
+    Given a list of items to check (workspace files, folders, git repositories,
+    files, etc), modify the list such that any items that no longer exist are
+    removed from the list on return. The list is modified in place.
+
+    The check done is based on the program doing the check and the item itself.
+    The checks are answered by the provided ExistenceCache (if any), which
+    allows a single clean run to share the work of checking between lists.
+    Items whose existence can't be determined are kept.
+
+    If a removed list is provided, the items removed are added to it.
+    """
+    if checked_items is None:
+        log.info("No items; doing nothing")
+        return False
+
+    if cache is None:
+        cache = ExistenceCache()
+
+    present, missing = [], []
+    with cache.stats.phase("clean_items: %s" % item_name):
+        cache.prefetch(item_location(item, program)[0] for item in checked_items)
+
+        for item in checked_items:
+            status_list = missing if cache.item_exists(item, program) is False else present
+            status_list.append(item)
+
+    if len(present) != len(checked_items):
+        log.info("Cleaning up %s:" % item_name)
+        for item in missing:
+            log.info("  %s", item_path(item, program))
+        log.info("Cleaned %d item(s)\n", len(missing))
+
+        if removed is not None:
+            removed.extend(missing)
+
+        checked_items[:] = present
+        return True
+
+    return False
+
+
+def find_values(document, pattern, path=()):
+    """
+    Yield a tuple of the path and value of everything in the loaded JSON
+    document whose path matches the pattern (see path_matches()), in the
+    order that they appear in the document.
+    """
+    if len(path) == len(pattern):
+        yield (path, document)
+        return
+
+    key = pattern[len(path)]
+    if key is None and isinstance(document, list):
+        for index, value in enumerate(document):
+            yield from find_values(value, pattern, path + (index,))
+    elif isinstance(document, dict) and key in document:
+        yield from find_values(document[key], pattern, path + (key,))
+
+
+class Compactor():
+    """
+    Perform the compaction actions requested in args, which are not about
+    removing items that no longer exist but about keeping the session (or a
+    workspace) from growing without bound:
+
+      - dedupe_history removes file_history items that already appear in an
+        earlier file history, such as in another window.
+      - max_history trims every history list to a maximum length.
+      - buffers drops the undo history of open buffers whose file no longer
+        exists; the buffer contents are left alone since they may be the only
+        copy of unsaved changes.
+
+    This works on loaded documents with compact(), and while streaming with
+    capture(), descend() and replace(), which are meant to be used with a
+    JsonStreamWalker. The buffers argument is the path to the list of
+    buffers, which is different in sessions and in workspaces.
+    """
+    # Histories are nested no deeper than this (e.g. windows[0].find.find_history)
+    history_depth = 4
+
+    def __init__(self, args, cache, buffers=("windows", None, "buffers")):
+        self.dedupe = args.dedupe_history
+        self.limit = args.max_history
+        self.drop_undo = args.buffers
+        self.cache = cache
+        self.buffer_file = buffers + (None, "file")
+        self.buffer_undo = buffers + (None, "undo_stack")
+
+        self.seen = set()
+        self.files = {}
+        self.deduped = self.trimmed = self.dropped = 0
+
+    def is_history(self, path):
+        return (0 < len(path) <= self.history_depth and
+                isinstance(path[-1], str) and path[-1].endswith("history"))
+
+    def compact_list(self, path, items):
+        """
+        Compact the history list at the given path in place, returning True
+        if anything was changed.
+        """
+        length = len(items)
+
+        if self.dedupe and path[-1] == "file_history":
+            kept = []
+            for item in items:
+                if not isinstance(item, str) or item not in self.seen:
+                    self.seen.add(item)
+                    kept.append(item)
+            self.deduped += len(items) - len(kept)
+            items[:] = kept
+
+        if self.limit is not None and len(items) > self.limit:
+            self.trimmed += len(items) - self.limit
+            del items[self.limit:]
+
+        return len(items) != length
+
+    def undo_droppable(self, file_name):
+        return (self.drop_undo and isinstance(file_name, str) and
+                self.cache.exists(*item_location(file_name, "text")) is False)
+
+    def compact(self, document):
+        """
+        Compact a loaded document in place, returning a tuple of a boolean
+        that says if anything changed and the paths of everything that was
+        looked at, for use with splice_session().
+        """
+        changed = False
+        paths = []
+
+        def histories(value, path):
+            if self.is_history(path) and isinstance(value, list):
+                yield (path, value)
+            elif len(path) < self.history_depth and isinstance(value, (dict, list)):
+                entries = value.items() if isinstance(value, dict) else enumerate(value)
+                for key, child in entries:
+                    yield from histories(child, path + (key,))
+
+        if self.dedupe or self.limit is not None:
+            for path, items in histories(document, ()):
+                paths.append(path)
+                changed = self.compact_list(path, items) or changed
+
+        if self.drop_undo:
+            buffers = [(path, buffer) for path, buffer in
+                       find_values(document, self.buffer_file[:-1])
+                       if isinstance(buffer, dict)]
+            self.cache.prefetch(item_location(buffer["file"], "text")[0]
+                                for path, buffer in buffers
+                                if isinstance(buffer.get("file"), str))
+
+            for path, buffer in buffers:
+                if buffer.get("undo_stack") and self.undo_droppable(buffer.get("file")):
+                    buffer["undo_stack"] = []
+                    self.dropped += 1
+                    paths.append(path + ("undo_stack",))
+                    changed = True
+
+        return (changed, paths)
+
+    def capture(self, path):
+        if (self.dedupe or self.limit is not None) and self.is_history(path):
+            return True
+
+        return self.drop_undo and (path_matches(self.buffer_file, path) or
+                                   path_matches(self.buffer_undo, path))
+
+    def descend(self, path):
+        return (len(path) < self.history_depth or
+                (self.drop_undo and path_matches(self.buffer_file[:len(path)], path)))
+
+    def replace(self, path, value):
+        """
+        Given the path and loaded value of a captured value, return True if
+        it has been modified in place. The undo stack of a buffer is replaced
+        by an empty list, which relies on Sublime writing the file name of a
+        buffer before its undo stack.
+        """
+        if path_matches(self.buffer_file, path):
+            self.files[path[:-1]] = value
+            return False
+
+        if path_matches(self.buffer_undo, path):
+            if value and self.undo_droppable(self.files.get(path[:-1])):
+                self.dropped += 1
+                value[:] = []
+                return True
+            return False
+
+        return isinstance(value, list) and self.compact_list(path, value)
+
+    def count(self):
+        return self.deduped + self.trimmed + self.dropped
+
+    def report(self):
+        if self.deduped:
+            log.info("Removed %d duplicate recent file(s)", self.deduped)
+        if self.trimmed:
+            log.info("Trimmed %d item(s) from histories longer than %d",
+                     self.trimmed, self.limit)
+        if self.dropped:
+            log.info("Dropped the undo history of %d buffer(s) for missing files",
+                     self.dropped)
+
+
+def load_and_clean(session_file, args, cache, report, session=None):
+    """
+    Load the whole session file into memory, clean it, and save the result to
+    a temporary file. Returns a tuple of a boolean that indicates whether
+    anything was cleaned and the name of the temporary file (None if nothing
+    was written), or (None, None) if there was an error.
+
+    If a session that has already been loaded is given, it is cleaned in place
+    instead of loading the session file, and is saved in full.
+
+    The removed items and the number of compacted items are recorded in the
+    report dictionary provided.
+    """
+    if session is None:
+        with cache.stats.phase("load_session"):
+            session, check_items, check_folders, check_files, text = load_session(session_file,
+                                                                                 args.program)
+        if session is None:
+            return (None, None)
+
+    else:
+        text = None
+        try:
+            check_items, check_folders, check_files = session_items(session, args.program)
+        except (KeyError, TypeError):
+            log.exception("Session could not be cleaned; invalid format?")
+            return (None, None)
+
+    check1 = check2 = check3 = False
+
+    # Check everything that we're going to clean in one go, so that all of
+    # the directories involved are listed together.
+    candidates = []
+    if args.workspaces and check_items:
+        candidates.extend(item_location(item, args.program)[0] for item in check_items)
+    if args.folders and check_folders:
+        candidates.extend(item_location(item, "merge")[0] for item in check_folders)
+    if args.files and check_files:
+        candidates.extend(item_location(item, args.program)[0]
+                          for file_list in check_files for item in file_list)
+    with cache.stats.phase("prefetch"):
+        cache.prefetch(candidates)
+
+    if args.workspaces:
+        item_type = "recent %s" % ("workspaces" if args.program == "text" else "repositories")
+        check1 = clean_items(check_items, args.program, item_type, cache,
+                             report["removed"])
+
+    if args.folders and check_folders:
+        # Force the program to be merge because merge handles folders for us
+        # transparently, and it doesn't support the notion of recent folders
+        # anyway.
+        check2 = clean_items(check_folders, "merge", "recent folders", cache,
+                             report["removed"])
+
+    if args.files and check_files:
+        for file_list in check_files:
+            check3 = clean_items(file_list, args.program, "recent files",
+                                 cache, report["removed"]) or check3
+
+    compactor = Compactor(args, cache)
+    with cache.stats.phase("compact"):
+        check4, compacted = compactor.compact(session)
+    compactor.report()
+    report["compacted"] = compactor.count()
+
+    if not any((check1, check2, check3, check4)):
+        return (False, None)
+
+    if args.dry_run:
+        return (True, None)
+
+    # Only the lists that were cleaned need to be written out; the full save
+    # is a fallback in case that fails.
+    patterns = [entry[0] for entry in session_lists(args.program)] + compacted
+    with cache.stats.phase("save_session"):
+        tmp_file = ((text is not None and splice_session(session_file, text, session, patterns))
+                    or save_session(session_file, session))
+    return (True, tmp_file) if tmp_file is not None else (None, None)
+
+
+def stream_and_clean(session_file, args, cache, report):
+    """
+    Clean the session file without loading all of it into memory, by walking
+    over the JSON and copying it to a temporary file while only loading and
+    cleaning the lists of recent items. The return value is the same as for
+    load_and_clean().
+    """
+    lists = [entry for entry in session_lists(args.program) if getattr(args, entry[1])]
+    compactor = Compactor(args, cache)
+    tmp_file = None if args.dry_run else session_file + ".tmp"
+    cleaned = []
+
+    def capture(path):
+        return (any(path_matches(entry[0], path) for entry in lists) or
+                compactor.capture(path))
+
+    def descend(path):
+        return (any(path_matches(entry[0][:len(path)], path) for entry in lists) or
+                compactor.descend(path))
+
+    def replace(path, raw):
+        value = json.loads(raw.decode("utf-8"))
+        changed = False
+
+        for pattern, action, program, item_name in lists:
+            if path_matches(pattern, path) and isinstance(value, list):
+                changed = clean_items(value, program, item_name, cache,
+                                      report["removed"]) or changed
+
+        if compactor.capture(path):
+            changed = compactor.replace(path, value) or changed
+
+        if changed:
+            cleaned.append(path)
+            return format_json(value, len(path)).encode("utf-8")
+
+        return None
+
+    try:
+        with open(session_file, "rb") as infile:
+            outfile = open(tmp_file, "wb") if tmp_file else None
+            try:
+                with cache.stats.phase("stream_session"):
+                    JsonStreamWalker(infile, outfile, capture, replace,
+                                     descend=descend).walk()
+                if outfile is not None:
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+            finally:
+                if outfile is not None:
+                    outfile.close()
+
+        compactor.report()
+        report["compacted"] = compactor.count()
+
+        # A temporary file is always written, but is only useful if something
+        # was actually cleaned.
+        if cleaned or tmp_file is None:
+            return (len(cleaned) > 0, tmp_file)
+
+        os.remove(tmp_file)
+        return (False, None)
+
+    except FileNotFoundError:
+        log.exception("Unable to locate session file")
+        return (None, None)
+
+    except ValueError:
+        log.exception("Session file could not be parsed; invalid JSON?")
+
+    except OSError:
+        log.exception("Error saving new session file")
+
+    if tmp_file is not None and os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    return (None, None)
+
+
+def unique_temp_file(file_name, mode_file=None):
+    """
+    Create a new temporary file alongside the given file, so that it can be
+    renamed into its place, returning a tuple of an open file descriptor and
+    the name of the file. The name is unique, so that processes writing the
+    same file at once never share a temporary file. The file is given the
+    permissions of mode_file (the given file by default) if it exists.
+    """
+    directory, base_name = os.path.split(file_name)
+    fd, tmp_file = tempfile.mkstemp(prefix=base_name + ".", suffix=".tmp",
+                                    dir=directory or os.curdir)
+    try:
+        shutil.copymode(mode_file or file_name, tmp_file)
+    except OSError:
+        pass
+
+    return fd, tmp_file
+
+
+def line_delta(base, new):
+    """
+    Given the lines of a base file and the lines of a new file (as lists of
+    bytes), return a list of operations that rebuild the new lines from the
+    base: ["c", start, count] copies count lines of the base starting at the
+    given line, and ["a", text] adds the lines in text (decoded as Latin-1, so
+    that any bytes survive a round trip through JSON).
+
+    Sessions are mostly the same from one day to the next, so the lines are
+    matched up by looking each one up in an index of the base; when a line
+    appears more than once, the one following the last copy is preferred.
+    """
+    index = {}
+    for number, line in enumerate(base):
+        index.setdefault(line, number)
+
+    ops = []
+    literal = []
+    position = 0
+    i = 0
+    while i < len(new):
+        line = new[i]
+        start = position if position < len(base) and base[position] == line else index.get(line)
+        count = 0
+        if start is not None:
+            count = 1
+            while (i + count < len(new) and start + count < len(base) and
+                   new[i + count] == base[start + count]):
+                count += 1
+
+        # A copy of a single short line takes more space than the line does.
+        if start is None or (count == 1 and len(line) < 32):
+            literal.append(line)
+            i += 1
+            position += 1
+            continue
+
+        if literal:
+            ops.append(["a", b"".join(literal).decode("latin-1")])
+            literal = []
+        ops.append(["c", start, count])
+        i += count
+        position = start + count
+
+    if literal:
+        ops.append(["a", b"".join(literal).decode("latin-1")])
+
+    return ops
+
+
+def apply_delta(base, ops):
+    """
+    Given the lines of a base file and the operations from line_delta(),
+    return the contents of the new file as bytes.
+    """
+    result = []
+    for op in ops:
+        if op[0] == "c":
+            result.extend(base[op[1]:op[1] + op[2]])
+        else:
+            result.append(op[1].encode("latin-1"))
+
+    return b"".join(result)
+
+
+class BackupPolicy():
+    """
+    Make backups of files that are about to be replaced (the session and any
+    workspaces), and prune old ones.
+
+    Backups are named for the file and the time they were made, with a number
+    added when there is already a backup from the same second; an existing
+    backup is never replaced. They can be compressed with gzip or xz, and can optionally be deltas that only store
+    the lines that differ from the most recent full backup; those are named
+    with a ".delta" extension, and start with a header line that names the
+    full backup they are based on.
+
+    Deltas are only made of files up to delta_limit bytes; larger files
+    always get a full backup.
+
+    When a number of backups to keep or a maximum age is given, backups
+    beyond that are removed after each new one is made, except for full
+    backups that a delta which is being kept is based on.
+    """
+    extensions = {"none": "", "gzip": ".gz", "xz": ".xz"}
+
+    # Making a delta holds the file and its base in memory several times over,
+    # so files larger than this always get a full backup, which is streamed.
+    delta_limit = 64 * 1024 * 1024
+
+    def __init__(self, compress="none", keep=None, max_age=None, delta=False):
+        self.compress = compress
+        self.keep = keep
+        self.max_age = max_age
+        self.delta = delta
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Create the policy configured by the given command line arguments.
+        """
+        return cls(args.backup_compress, args.backup_keep, args.backup_max_age,
+                   args.backup_delta)
+
+    @staticmethod
+    def open_file(file_name, mode="rb", raw=None):
+        """
+        Open a backup file, compressing or decompressing it based on the
+        extension of the file name. If a raw file object is given, it is used
+        instead of opening the file, and is left open when done.
+        """
+        target = file_name if raw is None else raw
+        if file_name.endswith(".gz"):
+            return gzip.open(target, mode, compresslevel=6)
+        if file_name.endswith(".xz"):
+            return lzma.open(target, mode)
+
+        return open(file_name, mode)
+
+    @classmethod
+    def read_header(cls, file_name):
+        """
+        Return the header of the given delta backup file.
+        """
+        with cls.open_file(file_name) as file:
+            return json.loads(file.readline().decode("utf-8"))
+
+    @classmethod
+    def read(cls, file_name):
+        """
+        Return the contents of the file that was backed up in the given backup
+        file, rebuilding it from its base first if it is a delta.
+        """
+        with cls.open_file(file_name) as file:
+            if not cls.is_delta(file_name):
+                return file.read()
+
+            header = json.loads(file.readline().decode("utf-8"))
+            ops = [json.loads(line.decode("utf-8")) for line in file]
+
+        base_file = os.path.join(os.path.dirname(file_name), header["base"])
+        content = apply_delta(cls.read(base_file).splitlines(keepends=True), ops)
+        if hashlib.sha256(content).hexdigest() != header["sha256"]:
+            raise ValueError("%s does not match its base %s" % (file_name, header["base"]))
+
+        return content
+
+    @staticmethod
+    def is_delta(file_name):
+        """
+        Return True if the given backup file is a delta.
+        """
+        return ".delta" in os.path.basename(file_name)
+
+    @staticmethod
+    def backups(file_name):
+        """
+        Return a list of the backups of the given file, as tuples of the time
+        the backup was made and the name of the backup file, oldest first.
+        """
+        directory, base_name = os.path.split(file_name)
+        pattern = re.compile(re.escape(base_name) +
+                             r"\.(\d{8}_\d{6})(?:_(\d+))?(\.delta)?(\.gz|\.xz)?$")
+        found = []
+        try:
+            names = os.listdir(directory or os.curdir)
+        except OSError:
+            return found
+
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                stamp = datetime.strptime(match.group(1), "%Y%m%d_%H%M%S")
+                found.append((stamp, int(match.group(2) or 0), os.path.join(directory, name)))
+
+        return [(stamp, name) for stamp, number, name in sorted(found)]
+
+    def make_delta(self, file_name):
+        """
+        Return the contents of a delta backup of the given file against its
+        most recent full backup, or None if there is no full backup or a delta
+        isn't worthwhile. This holds both versions of the file in memory, which
+        is why it's only used for files up to delta_limit bytes.
+        """
+        full = [name for stamp, name in self.backups(file_name) if not self.is_delta(name)]
+        if not full:
+            return None
+
+        try:
+            base = self.read(full[-1]).splitlines(keepends=True)
+        except (OSError, ValueError, EOFError, lzma.LZMAError):
+            log.warning("Unable to read %s; making a full backup instead", full[-1])
+            return None
+
+        with open(file_name, "rb") as file:
+            content = file.read()
+
+        ops = line_delta(base, content.splitlines(keepends=True))
+
+        # When most of the file has changed, a full backup is better, since it
+        # gives the deltas that follow a better base.
+        added = sum(len(op[1]) for op in ops if op[0] == "a")
+        if added >= len(content) / 2:
+            return None
+
+        header = {"base": os.path.basename(full[-1]),
+                  "sha256": hashlib.sha256(content).hexdigest()}
+        return "\n".join(json.dumps(item, ensure_ascii=False)
+                          for item in [header] + ops).encode("utf-8")
+
+    def write_backup(self, file_name, bkp_file):
+        """
+        Write a backup of the given file to the given backup file, as a delta
+        from the most recent full backup if desired (and worthwhile). Returns
+        the name of the backup file actually written, which has extensions
+        added for compression and deltas.
+
+        A full backup is copied (and compressed) a piece at a time, so that
+        backing up even a very large session doesn't need much memory.
+        """
+        extension = self.extensions[self.compress]
+
+        data = None
+        if self.delta and os.path.getsize(file_name) <= self.delta_limit:
+            data = self.make_delta(file_name)
+            if data is not None:
+                extension = ".delta" + extension
+
+        fd, tmp_file = unique_temp_file(bkp_file + extension, file_name)
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                if extension.endswith((".gz", ".xz")):
+                    with self.open_file(bkp_file + extension, "wb", raw) as file:
+                        self.write_content(file_name, data, file)
+                else:
+                    self.write_content(file_name, data, raw)
+
+                raw.flush()
+                os.fsync(raw.fileno())
+
+            return self.create_backup(tmp_file, bkp_file, extension)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    @classmethod
+    def create_backup(cls, source, bkp_file, extension=""):
+        """
+        Make the given source file a new backup file with the given name and
+        extension, as a hard link where possible and as a copy otherwise. The
+        backup is always created as a new file; if the name is already taken
+        (such as by another backup made in the same second), a number is added
+        to it until a free one is found. Returns the name of the backup file.
+
+        A name counts as taken when there is a backup by that name with any
+        extension, so that backups from the same second sort in the order they
+        were made.
+        """
+        for number in itertools.count():
+            stem = bkp_file + ("_%d" % number if number else "")
+            if any(os.path.exists(stem + delta + compressed)
+                   for delta in ("", ".delta") for compressed in cls.extensions.values()):
+                continue
+
+            name = stem + extension
+            try:
+                os.link(source, name)
+                return name
+            except FileExistsError:
+                continue
+            except OSError:
+                pass
+
+            try:
+                with open(source, "rb") as infile, open(name, "xb") as outfile:
+                    try:
+                        shutil.copyfileobj(infile, outfile, 1024 * 1024)
+                    except BaseException:
+                        outfile.close()
+                        os.remove(name)
+                        raise
+            except FileExistsError:
+                continue
+
+            shutil.copystat(source, name)
+            return name
+
+    @staticmethod
+    def write_content(file_name, data, target):
+        """
+        Write the given delta data to the target file, or when there is none,
+        copy the contents of the given file to it.
+        """
+        if data is not None:
+            return target.write(data)
+
+        with open(file_name, "rb") as file:
+            shutil.copyfileobj(file, target, 1024 * 1024)
+
+    def replace(self, file_name, tmp_file):
+        """
+        Put a newly saved temporary file into place, after making a backup of
+        the existing file and before pruning old backups. Returns the name of
+        the backup file, and raises OSError on failure.
+
+        The backup is always complete before the file is replaced, and the new
+        file atomically replaces the old one, so there is never a moment where
+        there is no file. An uncompressed full backup is made as a hard link
+        where possible.
+        """
+        bkp_file = file_name + datetime.now().strftime(".%Y%m%d_%H%M%S")
+        if self.compress == "none" and not self.delta:
+            bkp_file = self.create_backup(file_name, bkp_file)
+        else:
+            bkp_file = self.write_backup(file_name, bkp_file)
+
+        os.replace(tmp_file, file_name)
+        self.prune(file_name, bkp_file)
+
+        return bkp_file
+
+    def prune(self, file_name, latest):
+        """
+        Remove the backups of the given file that are beyond the number to
+        keep or older than the maximum age, other than the latest one and any
+        full backups that the deltas being kept are based on.
+        """
+        if self.keep is None and self.max_age is None:
+            return
+
+        backups = self.backups(file_name)
+        cutoff = None
+        if self.max_age is not None:
+            cutoff = datetime.now() - timedelta(days=self.max_age)
+
+        kept = set([latest])
+        for number, (stamp, name) in enumerate(reversed(backups)):
+            if ((self.keep is None or number < self.keep) and
+                    (cutoff is None or stamp >= cutoff)):
+                kept.add(name)
+
+        for name in list(kept):
+            if self.is_delta(name):
+                try:
+                    kept.add(os.path.join(os.path.dirname(name), self.read_header(name)["base"]))
+                except (OSError, ValueError, KeyError, EOFError, lzma.LZMAError):
+                    log.warning("Unable to read the header of %s", name)
+
+        for stamp, name in backups:
+            if name not in kept:
+                try:
+                    os.remove(name)
+                    log.info("Removed old backup %s", name)
+                except OSError:
+                    log.warning("Unable to remove old backup %s", name)
+
+
+def replace_session(session_file, tmp_file, policy, data_dir):
+    """
+    Put a newly saved temporary session file into place, keeping the existing
+    session file as a backup using the given BackupPolicy. Returns True on
+    success.
+    """
+    try:
+        bkp_file = policy.replace(session_file, tmp_file)
+
+        log.info("New session file saved")
+        log.info("Previous session backed up to: DATA_DIR%s%s" % (
+            os.path.sep,
+            os.path.relpath(bkp_file, data_dir)))
+
+        return True
+
+    except OSError:
+        log.exception("Error replacing session file")
+
+    return False
+
+
+def restore_session(args, backup_file):
+    """
+    Replace the session in the data directory with the session from the given
+    backup file (which can be compressed, or a delta), making a backup of the
+    current session first. Returns True on success.
+    """
+    session_file = os.path.join(args.data_dir, "Local", "Session.sublime_session")
+    if not os.path.exists(backup_file):
+        backup_file = os.path.join(args.data_dir, "Local", backup_file)
+
+    tmp_file = session_file + ".tmp"
+    try:
+        content = BackupPolicy.read(backup_file)
+        json.loads(content.decode("utf-8"))
+
+        with open(tmp_file, "wb") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+
+        log.info("Restoring session from %s", backup_file)
+        if not os.path.exists(session_file):
+            os.replace(tmp_file, session_file)
+            return True
+
+        return replace_session(session_file, tmp_file, BackupPolicy.from_args(args),
+                               args.data_dir)
+
+    except (OSError, EOFError, lzma.LZMAError):
+        log.exception("Unable to restore the session from %s", backup_file)
+
+    except ValueError:
+        log.exception("Backup %s could not be read; invalid JSON or delta?", backup_file)
+
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return False
+
+
+def session_workspaces(session_file):
+    """
+    Return the list of recent workspaces in the Sublime Text session file,
+    without loading the whole session.
+    """
+    found = []
+    pattern = ("workspaces", "recent_workspaces")
+
+    def capture(path):
+        return path == pattern
+
+    def replace(path, raw):
+        found.extend(json.loads(raw.decode("utf-8")))
+
+    with open(session_file, "rb") as file:
+        JsonStreamWalker(file, None, capture, replace,
+                         descend=lambda path: path == pattern[:len(path)]).walk()
+
+    return found
+
+
+def compact_workspace(workspace, args, cache):
+    """
+    Compact a single workspace file by streaming it through a JsonStreamWalker.
+    Recent files that no longer exist are removed, the undo history of buffers
+    for missing files is dropped and the histories are trimmed if requested.
+    The workspace is backed up and replaced in the same way as the session.
+
+    Returns True if the workspace was (or in a dry run, would be) changed.
+    """
+    options = argparse.Namespace(dedupe_history=False, max_history=args.max_history,
+                                 buffers=True)
+    compactor = Compactor(options, cache, buffers=("buffers",))
+    changed = []
+
+    def capture(path):
+        return path == ("file_history",) or compactor.capture(path)
+
+    def replace(path, raw):
+        value = json.loads(raw.decode("utf-8"))
+        cleaned = False
+        if path == ("file_history",) and isinstance(value, list):
+            cleaned = clean_items(value, "text", "recent files in %s" % workspace, cache)
+
+        if compactor.capture(path):
+            cleaned = compactor.replace(path, value) or cleaned
+
+        if cleaned:
+            changed.append(path)
+            return format_json(value, len(path)).encode("utf-8")
+
+        return None
+
+    # Several sessions being cleaned at once can share a workspace, so every
+    # compaction needs a temporary file of its own.
+    tmp_file = None
+    try:
+        fd, tmp_file = unique_temp_file(workspace)
+        with open(workspace, "rb") as infile, os.fdopen(fd, "wb") as outfile:
+            JsonStreamWalker(infile, outfile, capture, replace,
+                             descend=compactor.descend).walk()
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+        compactor.report()
+        if changed and not args.dry_run:
+            bkp_file = BackupPolicy.from_args(args).replace(workspace, tmp_file)
+            log.info("Compacted workspace %s; backed up to %s", workspace, bkp_file)
+            return True
+
+        return len(changed) > 0
+
+    except ValueError:
+        log.exception("Workspace %s could not be parsed; invalid JSON?", workspace)
+
+    except OSError:
+        log.exception("Error compacting workspace %s", workspace)
+
+    finally:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return False
+
+
+def _compact_in_process(workspace, args, shared):
+    """
+    Compact a single workspace as a part of compact_workspaces() in a worker
+    process.
+    """
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+    cache = make_cache(args, shared)
+    return (compact_workspace(workspace, args, cache), cache.learned)
+
+
+def find_workspaces(session_file, cache):
+    """
+    Return the resolved paths of the workspace files listed in the recent
+    workspaces of the given session that still exist, each listed once.
+    """
+    try:
+        workspaces = [item_location(item, "text")[0] for item in session_workspaces(session_file)
+                      if isinstance(item, str)]
+    except (OSError, ValueError):
+        log.exception("Unable to find the workspaces in the session")
+        return []
+
+    cache.prefetch(workspaces)
+    found = []
+    for path in workspaces:
+        path = os.path.realpath(path) if cache.exists(path, False) else None
+        if path is not None and path not in found:
+            found.append(path)
+
+    return found
+
+
+def compact_workspaces(workspaces, args, cache, parallel=True):
+    """
+    Compact the given workspace files, in parallel using a pool of processes
+    unless parallel is False. Returns the list of workspaces compacted.
+
+    Each workspace must only be given once; compacting the same file twice at
+    the same time would lose the changes from one of them.
+    """
+    if not parallel or args.processes == 1 or len(workspaces) < 2:
+        return [path for path in workspaces if compact_workspace(path, args, cache)]
+
+    compacted = []
+    with multiprocessing.Manager() as manager:
+        shared = manager.dict({parent: listing for parent, listing in cache.dirs.items()
+                               if not isinstance(listing, PartialListing)})
+
+        processes = args.processes or min(len(workspaces), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, (changed, learned) in zip(workspaces, pool.map(
+                    _compact_in_process, workspaces, [args] * len(workspaces),
+                    [shared] * len(workspaces))):
+                if changed:
+                    compacted.append(path)
+                cache.learned.update(learned)
+
+    return compacted
+
+
+def clean_session(args, cache=None, session=None, workspaces=True):
+    """
+    Load the session file from the data directory for the specified program and
+    perform the requested clean up operations to remove items that are marked
+    as recent but which no longer exist on disk, writing the session back.
+
+    This attempts to keep a backup of the existing session file and creates a
+    temporary session first in case things go pear shaped.
+
+    If no ExistenceCache is provided, one is created (and saved) for this run.
+    If a session that has already been loaded is provided, it is cleaned in
+    place instead of loading the session file. If workspaces is False, the
+    workspace files are not compacted; the ones that would be are listed in
+    the report under "workspace_files" for the caller to compact instead.
+
+    The return value is a dictionary that reports on what happened, including
+    the statistics collected along the way.
+    """
+    stats = Stats()
+    if cache is not None:
+        cache.stats = stats
+
+    report = {"data_dir": args.data_dir, "status": "error", "removed": [], "compacted": 0,
+              "workspaces": 0}
+    try:
+        _clean_session(args, cache, session, workspaces, stats, report)
+    finally:
+        report["stats"] = stats.as_dict()
+
+    return report
+
+
+def _clean_session(args, cache, session, workspaces, stats, report):
+    """
+    Perform the work of clean_session(), filling out the given report.
+    """
+    session_file = os.path.join(args.data_dir, "Local", "Session.sublime_session")
+    fingerprint_file = session_file + ".fingerprint"
+
+    actions = [args.program] + [action for action in ("workspaces", "folders", "files",
+                                                      "dedupe_history", "buffers",
+                                                      "workspace_files")
+                                if getattr(args, action)]
+    if args.max_history is not None:
+        actions.append("max_history=%d" % args.max_history)
+
+    log.info("Using Data Directory: %s", args.data_dir)
+    if args.dry_run:
+        log.info("--- PERFORMING DRY RUN: No Actions will be taken! ---")
+
+    if args.if_changed:
+        with stats.phase("fingerprint"):
+            unchanged = session_unchanged(session_file, fingerprint_file, actions)
+        if unchanged:
+            log.info("Session unchanged since it was last cleaned; nothing to do")
+            report["status"] = "unchanged"
+            return
+
+    save_cache = cache is None and not args.dry_run
+    if cache is None:
+        cache = make_cache(args, stats=stats)
+
+    if session is not None:
+        cleaned, tmp_file = load_and_clean(session_file, args, cache, report, session)
+    elif args.stream:
+        cleaned, tmp_file = stream_and_clean(session_file, args, cache, report)
+    else:
+        cleaned, tmp_file = load_and_clean(session_file, args, cache, report)
+    if cleaned is None:
+        return
+
+    if cleaned:
+        if args.dry_run:
+            log.info("--- PERFORMING DRY RUN: Session WILL NOT be modified ---")
+            report["status"] = "dry run"
+        else:
+            with stats.phase("replace_session"):
+                if replace_session(session_file, tmp_file,
+                                   BackupPolicy.from_args(args), args.data_dir):
+                    report["status"] = "cleaned"
+
+    else:
+        log.info("Nothing found to clean up")
+        report["status"] = "clean"
+
+    # Workspaces are compacted once the session has been cleaned, so that any
+    # that no longer exist are not considered. When the cache was given to us
+    # we're already running in parallel with other cleans, so the workspaces
+    # are done one at a time.
+    if args.workspace_files and args.program == "text":
+        with stats.phase("compact_workspaces"):
+            found = find_workspaces(session_file, cache)
+            if not workspaces:
+                report["workspace_files"] = found
+            else:
+                report["workspaces"] = len(compact_workspaces(found, args, cache,
+                                                              parallel=save_cache))
+
+    if save_cache:
+        with stats.phase("save_cache"):
+            cache.save()
+
+    if args.if_changed and not args.dry_run and report["status"] in ("cleaned", "clean"):
+        save_fingerprint(session_file, fingerprint_file, actions)
+
+
+def _clean_in_process(args, data_dir, shared):
+    """
+    Clean the session in a single data directory as a part of clean_sessions()
+    in a worker process. The cache entries learned are returned along with the
+    report, since only the main process saves the cache file.
+    """
+    logger = logging.getLogger()
+    if not logger.handlers:
+        logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+    for handler in logger.handlers:
+        handler.setFormatter(logging.Formatter(
+            "%(levelname)s:" + data_dir.replace("%", "%%") + ": %(message)s"))
+
+    args = argparse.Namespace(**vars(args))
+    args.data_dir = data_dir
+
+    cache = make_cache(args, shared)
+    report = clean_session(args, cache, workspaces=False)
+    report["removed"] = len(report["removed"])
+
+    return (report, cache.learned)
+
+
+def clean_sessions(args, data_dirs):
+    """
+    Clean the sessions in all of the given data directories at the same time
+    using a pool of worker processes, sharing directory listings between them,
+    and then log a summary of the results. The reports for each data directory
+    are returned.
+    """
+    reports = []
+    cache = ExistenceCache(cache_file=args.cache_file)
+
+    with multiprocessing.Manager() as manager:
+        shared = manager.dict()
+        processes = args.processes or min(len(data_dirs), os.cpu_count() or 1)
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(_clean_in_process, args, data_dir, shared)
+                       for data_dir in data_dirs]
+
+            for data_dir, future in zip(data_dirs, futures):
+                try:
+                    report, learned = future.result()
+                    cache.learned.update(learned)
+                except Exception:
+                    log.exception("Error cleaning %s", data_dir)
+                    report = {"data_dir": data_dir, "status": "error",
+                              "removed": 0, "compacted": 0, "workspaces": 0,
+                              "stats": None}
+
+                reports.append(report)
+
+    # Sessions can share workspaces, so instead of each worker compacting the
+    # workspaces of its own session (where two of them could be compacting
+    # the same file at once), they are gathered up here and each one is only
+    # compacted once.
+    workspaces = []
+    for report in reports:
+        workspaces.extend(path for path in report.get("workspace_files", [])
+                          if path not in workspaces)
+
+    compacted = set(compact_workspaces(workspaces, args, cache))
+    for report in reports:
+        report["workspaces"] = len(compacted.intersection(report.pop("workspace_files", [])))
+
+    if not args.dry_run:
+        cache.save()
+
+    log.info("Summary of %d session(s):", len(reports))
+    for report in reports:
+        log.info("  %-9s %4d removed %4d compacted %4d workspaces  %s",
+                 report["status"], report["removed"], report["compacted"],
+                 report["workspaces"], report["data_dir"])
+
+    log.info("Removed %d item(s), compacted %d item(s) and %d workspace(s) in total",
+             sum(report["removed"] for report in reports),
+             sum(report["compacted"] for report in reports), len(compacted))
+
+    return reports
+
+
+class CleanOptions(argparse.Namespace):
+    """
+    The options for a clean done with clean(); these are the same as the
+    command line arguments (with dashes replaced by underscores), and any that
+    are not given have the same defaults.
+    """
+    defaults = {
+        "program": "text",
+        "data_dir": None,
+        "processes": None,
+        "dry_run": False,
+        "analyze": False,
+        "stream": False,
+        "if_changed": False,
+        "stats": None,
+        "workers": 1,
+        "timeout": None,
+        "remote_workers": 2,
+        "mount_budget": None,
+        "cache_file": None,
+        "workspaces": False,
+        "files": False,
+        "folders": False,
+        "dedupe_history": False,
+        "max_history": None,
+        "buffers": False,
+        "workspace_files": False,
+        "backup_compress": "none",
+        "backup_keep": None,
+        "backup_max_age": None,
+        "backup_delta": False,
+        "restore": None
+    }
+
+    def __init__(self, **kwargs):
+        unknown = sorted(set(kwargs) - set(self.defaults))
+        if unknown:
+            raise TypeError("Unknown clean option(s): %s" % ", ".join(unknown))
+
+        super().__init__(**dict(self.defaults, **kwargs))
+
+
+def clean(options=None, session=None, cache=None, **kwargs):
+    """
+    Clean a session from Python code without having to run this as a script;
+    this takes a CleanOptions (or anything with the same attributes, like the
+    parsed command line arguments), and/or keyword arguments that set or
+    override individual options. If no data directory is given, the standard
+    one for the program is used.
+
+    A session that has already been loaded (such as with load_session()) can
+    be given, in which case it is cleaned in place instead of the session file
+    being loaded again; it is still written back to the session file unless
+    this is a dry run.
+
+    An ExistenceCache can be given to reuse the results of checking for items
+    between cleans; a cache given here is not saved, so call its save() method
+    when done. A single cache should not be used by two cleans at once.
+
+    Nothing is logged unless logging is configured to show messages from the
+    "sublime_session_clean" logger. The return value is a dictionary with the
+    following keys:
+      - data_dir: the data directory of the session cleaned
+      - status: one of "cleaned", "clean" (nothing to do), "dry run",
+        "unchanged" (with if_changed) or "error"
+      - removed: a list of the items removed from the recent item lists
+      - compacted: the number of items removed by compaction
+      - workspaces: the number of workspace files compacted
+      - stats: timings and counters, as written out by --stats
+    """
+    options = CleanOptions(**dict(vars(options) if options is not None else {}, **kwargs))
+    if not options.data_dir:
+        options.data_dir = sublime_data_dir(options.program)
+    options.data_dir = os.path.expanduser(options.data_dir)
+
+    return clean_session(options, cache, session)
+
+
+def write_stats(stats_file, reports):
+    """
+    Write the statistics from the given clean reports as JSON to the given
+    file, or to standard output if the file name is "-". Does nothing if no
+    file is given.
+    """
+    if stats_file is None:
+        return
+
+    sessions = []
+    for report in reports:
+        removed = report["removed"]
+        sessions.append({
+            "data_dir": report["data_dir"],
+            "status": report["status"],
+            "removed": removed if isinstance(removed, int) else len(removed),
+            "compacted": report["compacted"],
+            "workspaces": report["workspaces"],
+            "stats": report["stats"]
+        })
+
+    result = json.dumps({"version": 1, "sessions": sessions}, indent=2)
+    if stats_file == "-":
+        print(result)
+        return
+
+    try:
+        with open(stats_file, "w", encoding="utf-8") as file:
+            file.write(result + "\n")
+    except OSError:
+        log.exception("Error writing statistics to %s", stats_file)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+
+    parser = argparse.ArgumentParser(description="Clean Sublime Text/Merge session files",
+                                     epilog="At least one cleanup action must be selected unless analyzing",
+                                     prefix_chars="-+")
+    parser.add_argument("--program", "-p",
+                        help="Specify the program to clean [Default: text]",
+                        choices=["text", "merge"],
+                        default="text")
+    parser.add_argument("--data-dir", "-d",
+                        help="Specify the Sublime Data directory to use; can be given more "
+                             "than once and can be a wildcard to clean several at once",
+                        action="append")
+
+    parser.add_argument("--processes", "-P",
+                        help="Number of data directories to clean at once [Default: one per CPU]",
+                        type=int)
+
+    parser.add_argument("--dry-run",
+                        help="Run clean but don't write the new session file",
+                        action="store_true")
+
+    parser.add_argument("--analyze", "-a",
+                        help="Report on the size of the session instead of cleaning it",
+                        action="store_true")
+
+    parser.add_argument("--stream", "-s",
+                        help="Clean without loading the whole session into memory",
+                        action="store_true")
+
+    parser.add_argument("--if-changed",
+                        help="Do nothing if the session hasn't changed since it was last cleaned",
+                        action="store_true")
+
+    parser.add_argument("--stats",
+                        help="Write statistics on where the time went as JSON to this file "
+                             "(or standard output if no file is given)",
+                        metavar="FILE",
+                        nargs="?",
+                        const="-")
+
+    parser.add_argument("--workers", "-j",
+                        help="Number of paths to check at once [Default: 1]",
+                        type=int,
+                        default=1)
+    parser.add_argument("--timeout", "-t",
+                        help="Seconds to wait for a path check before assuming that the path exists",
+                        type=float)
+    parser.add_argument("--remote-workers",
+                        help="Number of paths on a single network mount to check at once [Default: 2]",
+                        type=int,
+                        default=2)
+    parser.add_argument("--mount-budget",
+                        help="Seconds of checking to allow per network mount before skipping the rest of it",
+                        type=float)
+    parser.add_argument("--cache-file", "-c",
+                        help="Remember the results of path checks in this file between runs")
+
+    backups = parser.add_argument_group("Session Backups")
+
+    backups.add_argument("--backup-compress",
+                        help="Compress backups of the session and workspaces [Default: none]",
+                        choices=["none", "gzip", "xz"],
+                        default="none")
+    backups.add_argument("--backup-keep",
+                        help="Keep at most this many backups, removing the oldest ones",
+                        metavar="N",
+                        type=int)
+    backups.add_argument("--backup-max-age",
+                        help="Remove backups older than this many days",
+                        metavar="DAYS",
+                        type=float)
+    backups.add_argument("--backup-delta",
+                        help="Only store the lines that changed since the last full backup",
+                        action="store_true")
+    backups.add_argument("--restore",
+                        help="Restore the session from the given backup file instead of cleaning",
+                        metavar="BACKUP")
+
+    actions = parser.add_argument_group("Available Cleanup Actions")
+
+    actions.add_argument("--workspaces", "-w",
+                        help="Clean up recently used workspaces, projects and repositories",
+                        action="store_true")
+
+    actions.add_argument("--files", "-f",
+                        help="Clean up recently used files",
+                        action="store_true")
+
+    actions.add_argument("--folders", "-o",
+                        help="Clean up recently used folders [Default: False]",
+                        action="store_true")
+
+    actions.add_argument("--dedupe-history",
+                        help="Remove recent files that already appear in another window's history",
+                        action="store_true")
+
+    actions.add_argument("--max-history",
+                        help="Trim every history list to at most this many items",
+                        metavar="N",
+                        type=int)
+
+    actions.add_argument("--buffers",
+                        help="Drop the undo history of open buffers whose files no longer exist",
+                        action="store_true")
+
+    actions.add_argument("--workspace-files",
+                        help="Compact the workspace files of recent projects (Sublime Text only)",
                         action="store_true")
 
     args = parser.parse_args()
-    if not any([args.workspaces, args.files, args.folders]):
+    if not any([args.workspaces, args.files, args.folders, args.dedupe_history,
+                args.max_history is not None, args.buffers, args.workspace_files,
+                args.analyze, args.restore]):
         parser.error("You must specify at least one cleanup option")
 
     # Need to set the default data_dir last so it can pick up the program.
-    args.data_dir = args.data_dir or sublime_data_dir(args.program)
+    data_dirs = []
+    for pattern in args.data_dir or [sublime_data_dir(args.program)]:
+        matches = sorted(glob.glob(os.path.expanduser(pattern))) or [pattern]
+        data_dirs.extend(path for path in matches if path not in data_dirs)
 
-    clean_session(args)
+    if args.restore:
+        if len(data_dirs) > 1:
+            parser.error("Only one data directory can be restored at a time")
+        args.data_dir = data_dirs[0]
+        sys.exit(0 if restore_session(args, args.restore) else 1)
+    elif args.analyze:
+        for args.data_dir in data_dirs:
+            analyze_session(args)
+    elif len(data_dirs) > 1:
+        write_stats(args.stats, clean_sessions(args, data_dirs))
+    else:
+        args.data_dir = data_dirs[0]
+        write_stats(args.stats, [clean_session(args)])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Tests for sublime_session_clean.py; run with:
+
+    python3 -m unittest test_sublime_session_clean
+"""
+
+from datetime import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import sublime_session_clean
+
+
+class FixedDateTime(datetime):
+    """
+    A datetime whose now() is always the same moment, so that every backup
+    made while it is in use is made in the same second.
+    """
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2020, 1, 2, 3, 4, 5)
+
+
+class BackupPolicyTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.file_name = os.path.join(self.directory.name, "Session.sublime_session")
+
+    @staticmethod
+    def content(version):
+        return ('{"version": %d, "lines": [\n%s\n]}\n' % (
+            version, ",\n".join('"line %d"' % line for line in range(50)))).encode()
+
+    def replace_twice(self, policy):
+        """
+        Replace the file twice in the same second with the given policy,
+        returning the contents it had before each replacement and the names
+        of the backups made.
+        """
+        with open(self.file_name, "wb") as file:
+            file.write(self.content(0))
+
+        backups = []
+        for version in (1, 2):
+            tmp_file = self.file_name + ".tmp"
+            with open(tmp_file, "wb") as file:
+                file.write(self.content(version))
+
+            with mock.patch.object(sublime_session_clean, "datetime", FixedDateTime):
+                backups.append(policy.replace(self.file_name, tmp_file))
+
+        return [self.content(0), self.content(1)], backups
+
+    def check_backups(self, policy):
+        contents, backups = self.replace_twice(policy)
+
+        self.assertEqual(len(set(backups)), 2)
+        self.assertEqual([name for stamp, name in policy.backups(self.file_name)], backups)
+        for content, backup in zip(contents, backups):
+            self.assertEqual(sublime_session_clean.BackupPolicy.read(backup), content)
+
+    def test_same_second(self):
+        self.check_backups(sublime_session_clean.BackupPolicy())
+
+    def test_same_second_compressed(self):
+        self.check_backups(sublime_session_clean.BackupPolicy(compress="gzip"))
+
+    def test_same_second_delta(self):
+        self.check_backups(sublime_session_clean.BackupPolicy(delta=True))
+
+    def test_same_second_without_links(self):
+        with mock.patch.object(os, "link", side_effect=PermissionError):
+            self.check_backups(sublime_session_clean.BackupPolicy())
+
+
+if __name__ == "__main__":
+    unittest.main()